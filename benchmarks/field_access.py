@@ -0,0 +1,55 @@
+"""
+Microbenchmark comparing attribute reads on a `Document` subclass.
+
+Fields declared on a `Document` subclass are compiled when the class is
+created. The "generic" case declares the same class, but switches its fields
+back to their generic (un-compiled) descriptor code.
+
+Run with: python benchmarks/field_access.py
+"""
+
+import timeit
+
+from docbridge import Document, FallthroughField, Field
+
+DOC = {"_id": "1234", "user_id": "4", "full_name": "Deborah White"}
+
+
+class Profile(Document):
+    id = Field(field_name="_id")
+    user_id = Field(transform=int)
+    name = FallthroughField(["name", "full_name"])
+
+
+class GenericProfile(Document):
+    id = Field(field_name="_id")
+    user_id = Field(transform=int)
+    name = FallthroughField(["name", "full_name"])
+
+
+for _field in (GenericProfile.id, GenericProfile.user_id):
+    _field.__class__ = _field._generic_class
+
+
+def main():
+    compiled = Profile(DOC, None)
+    generic = GenericProfile(DOC, None)
+
+    cases = [
+        ("dict lookup", "doc['_id']"),
+        ("compiled Field", "compiled.id"),
+        ("generic Field", "generic.id"),
+        ("compiled Field(transform=int)", "compiled.user_id"),
+        ("generic Field(transform=int)", "generic.user_id"),
+        ("FallthroughField", "compiled.name"),
+    ]
+    namespace = {"doc": DOC, "compiled": compiled, "generic": generic}
+    for label, statement in cases:
+        timer = timeit.Timer(statement, globals=namespace)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=5, number=number)) / number
+        print(f"{label:32} {best * 1e9:8.1f} ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Microbenchmark comparing reads of a few fields from a wide BSON document.
+
+The "decoded" case decodes the whole document up-front (which is what PyMongo
+does by default). The "lazy" case passes the raw bytes to `Document`, so only
+the fields that are read get decoded.
+
+Run with: python benchmarks/lazy_bson.py
+"""
+
+import timeit
+
+import bson
+
+from docbridge import Document, Field
+
+WIDE_DOC = {
+    "user_id": "4",
+    "full_name": "Deborah White",
+    "email": "deanjacob@yahoo.com",
+    **{f"field_{i}": f"value {i}" for i in range(200)},
+    "followers": [
+        {"user_id": str(i), "user_name": f"@user{i}", "bio": "Rich beautiful color."}
+        for i in range(1000)
+    ],
+}
+RAW = bson.encode(WIDE_DOC)
+
+
+class Profile(Document):
+    user_id = Field(transform=int)
+    name = Field(field_name="full_name")
+    email = Field()
+
+
+def read_decoded():
+    profile = Profile(bson.decode(RAW), None)
+    return profile.user_id, profile.name, profile.email
+
+
+def read_lazy():
+    profile = Profile(RAW, None)
+    return profile.user_id, profile.name, profile.email
+
+
+def main():
+    for label, function in [("decoded", read_decoded), ("lazy", read_lazy)]:
+        timer = timeit.Timer(function)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=5, number=number)) / number
+        print(f"{label:10} {best * 1e6:8.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,11 @@
 from contextlib import asynccontextmanager
-from datetime import datetime
 import os
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response, StreamingResponse
 
 from motor.motor_asyncio import AsyncIOMotorClient
-# from docbridge import Document, Field, SequenceField
-from beanie import Document, init_beanie
-from pydantic import BaseModel, Field
-
+from docbridge import Document, Field, SequenceField
 
 
 CONNECTION_STRING = os.environ["MDB_URI"]
@@ -23,9 +20,7 @@ async def db_lifespan(app: FastAPI):
         raise Exception("Problem connecting to database cluster.")
     else:
         print("Connected to database cluster.")
-    
-    await init_beanie(database=db, document_models=[Profile])
-    
+
     yield
 
     # Shutdown
@@ -35,25 +30,33 @@ async def db_lifespan(app: FastAPI):
 app = FastAPI(lifespan=db_lifespan)
 
 
-class Follower(BaseModel):
-    user_id: str
+class Follower(Document, strict=True):
+    user_id = Field()
 
-class Profile(Document):
-    user_id: str
-    user_name: str
-    full_name: str
-    birth_date: datetime
-    email: str
-    followers: list[Follower]
 
-    class Settings:
-        name = "profiles"
-        
+class Profile(Document, strict=True):
+    user_id = Field()
+    user_name = Field()
+    full_name = Field()
+    birth_date = Field()
+    email = Field()
+    followers = SequenceField(type=Follower)
 
 
-@app.get("/profiles/{user_id}")
-async def read_item(user_id: str) -> Profile:
-    print(dir(Profile))
-    profile = await Profile.find_one({"user_id": user_id})
+@app.get("/profiles")
+async def list_profiles():
+    cursor = app.database.get_collection("profiles").find({}, Profile.projection())
+    return StreamingResponse(
+        Profile.stream_json(cursor, db=app.database), media_type="application/json"
+    )
 
-    return profile
+
+@app.get("/profiles/{user_id}")
+async def read_item(user_id: str):
+    doc = await app.database.get_collection("profiles").find_one(
+        {"user_id": user_id}, Profile.projection()
+    )
+    if doc is None:
+        raise HTTPException(status_code=404)
+
+    return Response(Profile(doc, app.database).to_json(), media_type="application/json")
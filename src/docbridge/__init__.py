@@ -16,22 +16,116 @@
 docbridge - An experimental Object-Document Mapper library, primarily designed for teaching.
 """
 
-from typing import Any, Sequence, Mapping, Iterable, Callable
+import asyncio
+import base64
+from collections import OrderedDict
+from collections.abc import MutableMapping, MutableSequence
+import contextlib
+import contextvars
+import copy
+import datetime
+import inspect
+import itertools
+import json
+import logging
+import queue
+import struct
+import time
+import threading
+import uuid
+import weakref
+from typing import Any, Sequence, Mapping, Iterable, Callable, NamedTuple, Optional
 
-__all__ = ["Document", "FallthroughField", "Field", "SequenceField"]
+import bson
+from bson import json_util
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, WriteError
+
+__all__ = [
+    "ConflictError",
+    "Document",
+    "DocumentArray",
+    "DocumentCache",
+    "DocumentSequence",
+    "FallthroughField",
+    "Field",
+    "LazyBSONDocument",
+    "MigrationWriter",
+    "ReferenceField",
+    "ReferenceLoader",
+    "SaveResult",
+    "SequenceField",
+    "UnitOfWork",
+    "ValidationError",
+    "WriteBehindBuffer",
+    "migration",
+    "reference_scope",
+]
 
 _SENTINEL = object()
 NO_DEFAULT = object()
 
+_logger = logging.getLogger(__name__)
+
+
+class ConflictError(Exception):
+    """
+    Raised when saving a versioned `Document` which was modified by someone else since it was loaded.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        super().__init__(
+            f"{type(document).__name__} {document._doc.get('_id')!r} was modified "
+            f"since it was loaded, so the update was not applied."
+        )
+
+
+class ValidationError(ValueError):
+    """
+    Raised when a document doesn't match the fields declared on a `Document` class.
+
+    `errors` maps each invalid attribute name to a description of the
+    problem, and `document_id` is the `_id` of the document, if it has one.
+    """
+
+    def __init__(self, errors, document_id=None):
+        self.errors = errors
+        self.document_id = document_id
+        super().__init__(
+            f"Document {document_id!r} is invalid: " + " ".join(errors.values())
+        )
+
 
 class DocumentMeta(type):
-    def __new__(cls, name, bases, dict, strict=False, **kwds):
-        result = super().__new__(cls, name, bases, dict, **kwds)
-        result._strict = strict
-        return result
+    """
+    Metaclass for `Document`, which gives every subclass empty `__slots__`.
+
+    This means instances only carry the slots declared on `Document`, and never
+    a per-instance `__dict__`, unless a subclass explicitly asks for one, or
+    declares plain class attributes (like `x = None`), which instances must
+    be able to shadow with their own values.
+    """
+
+    def __new__(cls, name, bases, dict, **kwds):
+        if "__slots__" not in dict:
+            has_dict = any(base.__dictoffset__ for base in bases)
+            if not has_dict and any(
+                not (key.startswith("__") and key.endswith("__"))
+                and not hasattr(type(value), "__get__")
+                for key, value in dict.items()
+            ):
+                dict["__slots__"] = ("__dict__",)
+            else:
+                dict["__slots__"] = ()
+        return super().__new__(cls, name, bases, dict, **kwds)
 
 
-class Document:
+class Document(metaclass=DocumentMeta):
     """
     An object wrapper for a BSON document.
 
@@ -39,63 +133,1177 @@ class Document:
     configured for attribute lookup.
     """
 
-    _doc = None
-    _db = None
-    _modified_fields = None
+    __slots__ = (
+        "_doc",
+        "_db",
+        "_dirty",
+        "_wrapped",
+        "_related",
+        "_parent",
+        "_pending",
+    )
+
     _strict = False
+    _fields = {}
+    _fallthroughs = {}
+    _projection = None
+    _migrations = {}
+    _schema_version_field = "schema_version"
+    _validate_on_load = False
+    _version_field = None
 
     def __init__(self, doc, db):
-        self._doc = doc
-        self._db = db
-        self._modified_fields = {}
+        if isinstance(doc, (bytes, RawBSONDocument)):
+            doc = _lazy_document(doc, db)
+        # Assign the slots directly, bypassing __setattr__, as this is on the
+        # hot path when hydrating documents from a cursor.
+        if self._migrations:
+            # Leave `_doc` unset, so that the document is migrated on first access:
+            _set_pending(self, doc)
+        else:
+            if self._validate_on_load:
+                self._validator(doc)
+            _set_doc(self, doc)
+        _set_db(self, db)
+        _set_dirty(self, None)
+        _set_wrapped(self, None)
+        _set_related(self, None)
+        _set_parent(self, None)
+
+    @classmethod
+    def from_cursor(cls, cursor, db):
+        """
+        Wrap each document yielded by `cursor` in an instance of this class.
+
+        If `cursor` is async iterable (like a Motor cursor) then an async
+        iterator is returned, otherwise (like a PyMongo cursor) a regular
+        iterator is returned. Either way, documents are wrapped one at a time,
+        as they are consumed.
+        """
+        if hasattr(cursor, "__aiter__"):
+            return cls._from_async_cursor(cursor, db)
+        return map(cls, cursor, itertools.repeat(db))
+
+    @classmethod
+    async def _from_async_cursor(cls, cursor, db):
+        async for doc in cursor:
+            yield cls(doc, db)
+
+    @property
+    def _modified_fields(self):
+        """
+        The fields that have been set since this document was loaded or saved.
+
+        Fields modified through wrapped sub-documents and arrays are recorded
+        here (on the top-level document) as dotted paths. The underlying
+        `_Changes` are only allocated on the first write, so this returns an
+        empty dict for unmodified documents.
+        """
+        return {} if self._dirty is None else self._dirty.sets
+
+    @_modified_fields.setter
+    def _modified_fields(self, value):
+        _set_dirty(self, None)
+        for path, field_value in value.items():
+            self._changes().set(self._doc, path, _unwrap(field_value))
+
+    def _changes(self):
+        if self._dirty is None:
+            _set_dirty(self, _Changes())
+            unit_of_work = _unit_of_work.get()
+            if unit_of_work is not None and isinstance(
+                self, unit_of_work.document_class
+            ):
+                unit_of_work.add(self)
+        return self._dirty
+
+    def _mark_modified(self, key, value):
+        root, path = _change_path(self, key)
+        if root is not None:
+            root._changes().set(root._doc, path, value)
+
+    def _mark_unset(self, key):
+        root, path = _change_path(self, key)
+        if root is not None:
+            root._changes().unset(root._doc, path)
 
     def __getattr__(self, attr):
         if attr == "_doc":
+            if self._migrations:
+                return self._migrate()
             return object.__getattribute__(self, attr)
-        if not self._strict:
-            return self._wrap(self._doc[attr])
+        if not self._strict and not (attr.startswith("__") and attr.endswith("__")):
+            return self._wrapped_value(attr)
 
         else:
             raise AttributeError(
                 f"{self.__class__.__name__!r} object has no attribute {attr!r}"
             )
 
-    def _wrap(self, value):
-        if isinstance(value, dict):
-            return Document(value, self._db)
-        elif isinstance(value, list):
-            result = [self._wrap(item) for item in value]
-            return result
-        else:
+    def _migrate(self):
+        """
+        Apply the class's migrations to the pending document, and store it as `_doc`.
+
+        If the document was migrated, and a `MigrationWriter` is active, the
+        changes made by the migrations are queued to be written back to the
+        database.
+        """
+        pending = self._pending
+        writer = before = None
+        if self._parent is None:
+            writer = _migration_writer.get()
+            if writer is not None and isinstance(self, writer.document_class):
+                # Keep a copy, to work out what the migrations changed:
+                before = copy.deepcopy(dict(pending))
+
+        doc, original, version = self._apply_migrations(pending)
+        if self._validate_on_load:
+            self._validator(doc)
+        _set_doc(self, doc)
+        _set_pending(self, None)
+
+        if version != original and before is not None:
+            writer.add(self, original, _migration_update(before, doc))
+        return doc
+
+    @classmethod
+    def _apply_migrations(cls, doc):
+        """
+        Apply the class's migrations to `doc`.
+
+        Returns the migrated document, and its original and new schema versions.
+        """
+        field = cls._schema_version_field
+        version = original = doc.get(field)
+        migrations = cls._migrations
+        while version in migrations:
+            version, migrate = migrations[version]
+            migrated = migrate(doc)
+            if migrated is not None:
+                doc = migrated
+            doc[field] = version
+        return doc, original, version
+
+    def _wrapped_value(self, key):
+        """
+        Look up `key` in the underlying document, wrapping sub-documents and arrays.
+
+        Wrapped values are cached per instance, along with the raw value they
+        wrap, so repeated lookups return the same wrapper without allocating.
+        The cached wrapper is only returned while the underlying document
+        still holds the same raw object, so replacing the value invalidates it.
+        """
+        value = self._doc[key]
+        if not isinstance(value, (dict, list)):
             return value
 
+        cache = self._wrapped
+        if cache is None:
+            cache = {}
+            _set_wrapped(self, cache)
+        else:
+            cached = cache.get(key)
+            if cached is not None and cached[0] is value:
+                return cached[1]
+
+        wrapped = self._wrap(value, key)
+        cache[key] = (value, wrapped)
+        return wrapped
+
+    def _invalidate(self, key):
+        cache = self._wrapped
+        if cache is not None:
+            cache.pop(key, None)
+            # FallthroughFields which might now resolve to a different field:
+            for field in self._fallthroughs.get(key, ()):
+                cache.pop(field, None)
+
+    def _wrap(self, value, key=None):
+        return _wrap(value, self._db, self, key)
+
     def __setattr__(self, name: str, value: Any) -> None:
         if hasattr(self.__class__, name):
             super().__setattr__(name, value)
         elif not self._strict:
-            self._doc[name] = value
-            self._modified_fields[name] = value
+            # Store wrapped values (like an array after `+=`) as plain BSON:
+            value = self._doc[name] = _unwrap(value)
+            self._invalidate(name)
+            self._mark_modified(name, value)
         else:
             raise AttributeError(
                 f"{self.__class__.__name__!r} cannot have instance attributes dynamically assigned."
             )
 
-    async def save(self, collection, match_criteria=None, session=None):
-        if match_criteria is None:
+    def __delattr__(self, name: str) -> None:
+        if hasattr(self.__class__, name):
+            super().__delattr__(name)
+        elif not self._strict:
             try:
-                match_criteria = {"_id": self._doc["_id"]}
-            except Exception:
-                raise Exception(
-                    "Attempt to update a document without _id, without providing `match_criteria`."
-                )
-        await self._db.get_collection(collection).update_one(
-            match_criteria, {"$set": self._modified_fields}, session=session
+                del self._doc[name]
+            except KeyError as ke:
+                raise AttributeError(
+                    f"{self.__class__.__name__!r} object has no attribute {name!r}"
+                ) from ke
+            self._invalidate(name)
+            self._mark_unset(name)
+        else:
+            raise AttributeError(
+                f"{self.__class__.__name__!r} cannot have instance attributes dynamically deleted."
+            )
+
+    async def save(
+        self,
+        collection,
+        match_criteria=None,
+        session=None,
+        on_conflict=None,
+        max_retries=3,
+    ):
+        """
+        Write the changes made to this document to `collection`.
+
+        If the class declares a `version_field`, the update only matches if
+        the stored document still has the version this one was loaded with,
+        and the version is incremented. If it doesn't match, because the
+        document was updated by someone else in the meantime, a
+        `ConflictError` is raised. If `on_conflict` is provided, the document
+        is reloaded instead, `on_conflict` is called with it (and awaited, if
+        it's a coroutine function) to re-apply the changes, and the save is
+        retried, up to `max_retries` times.
+        """
+        buffer = _write_behind_buffer.get()
+        if (
+            buffer is not None
+            and buffer.collection == collection
+            and match_criteria is None
+            and session is None
+            and self._version_field is None
+        ):
+            # The changes will be written when the buffer is flushed:
+            buffer.add(self)
+            return None
+
+        version_field = self._version_field
+        target = self._db.get_collection(collection)
+        for attempt in itertools.count():
+            if match_criteria is None:
+                criteria = self._match_criteria()
+            elif version_field is not None:
+                criteria = dict(match_criteria)
+                criteria[version_field] = self._doc.get(version_field)
+            else:
+                criteria = match_criteria
+            result = await target.update_one(
+                criteria, self._update_document(), session=session
+            )
+            if version_field is None or result.matched_count:
+                break
+            if on_conflict is None or attempt == max_retries:
+                raise ConflictError(self)
+            await self._reload(target, session)
+            reapplied = on_conflict(self)
+            if inspect.isawaitable(reapplied):
+                await reapplied
+
+        self._mark_saved()
+        _invalidate_caches(self._db, collection, self._doc.get("_id", _SENTINEL))
+        return result
+
+    async def _reload(self, collection, session=None):
+        """
+        Replace this document's data with the current version from `collection`.
+        """
+        doc = await collection.find_one(
+            {"_id": self._doc["_id"]}, self.projection(), session=session
         )
-        self._modified_fields = {}
-        # TODO: Return something that details the update - error if no document updated?
+        if doc is None:
+            raise ConflictError(self)
+        if isinstance(doc, (bytes, RawBSONDocument)):
+            doc = _lazy_document(doc, collection)
+        if self._migrations:
+            doc = self._apply_migrations(doc)[0]
+        _set_doc(self, doc)
+        _set_dirty(self, None)
+        _set_wrapped(self, None)
+        _set_related(self, None)
 
-    def __init_subclass__(cls, /, strict=False):
+    def _match_criteria(self):
+        try:
+            criteria = {"_id": self._doc["_id"]}
+        except Exception:
+            raise Exception(
+                "Attempt to update a document without _id, without providing `match_criteria`."
+            )
+        if self._version_field is not None:
+            criteria[self._version_field] = self._doc.get(self._version_field)
+        return criteria
+
+    def _update_document(self):
+        update = self._dirty.update_document() if self._dirty else {}
+        if self._version_field is not None:
+            update["$inc"] = {self._version_field: 1}
+        # An update document can't be empty, so an unmodified document is a no-op $set:
+        return update or {"$set": {}}
+
+    def _next_version(self):
+        version = self._doc.get(self._version_field)
+        return 1 if version is None else version + 1
+
+    def _mark_saved(self):
+        """
+        Clear the recorded changes after they've been written, and advance the version.
+        """
+        _set_dirty(self, None)
+        version_field = self._version_field
+        if version_field is not None:
+            self._doc[version_field] = self._next_version()
+            self._invalidate(version_field)
+
+    def _matched(self, stored):
+        """
+        Return True if `stored` (the document read back after an update) shows the update matched.
+        """
+        if stored is None:
+            return False
+        if self._version_field is None:
+            return True
+        return stored.get(self._version_field) == self._next_version()
+
+    def __init_subclass__(
+        cls,
+        /,
+        strict=False,
+        schema_version_field=None,
+        validate=False,
+        version_field=None,
+    ):
         cls._strict = strict
+        cls._validate_on_load = validate
+        if version_field is not None:
+            cls._version_field = version_field
+        if schema_version_field is not None:
+            cls._schema_version_field = schema_version_field
+
+        migrations = dict(cls._migrations)
+        for attr in cls.__dict__.values():
+            if inspect.isfunction(attr) and hasattr(attr, "_migration"):
+                from_version, to_version = attr._migration
+                migrations[from_version] = (to_version, attr)
+        cls._migrations = _check_migrations(migrations)
+
+        # Compile a specialised getter for each field declared on this class
+        # that supports it. Inherited fields were compiled when their own
+        # class was created.
+        fields = dict(cls._fields)
+        for name, attr in cls.__dict__.items():
+            if hasattr(type(attr), "_projected_fields"):
+                if hasattr(type(attr), "_compile"):
+                    _specialise(attr, attr._compile())
+                fields[name] = attr
+        cls._fields = fields
+        fallthroughs = {}
+        for attr in fields.values():
+            for field_name in getattr(attr, "field_names", ()):
+                fallthroughs.setdefault(field_name, []).append(attr)
+        cls._fallthroughs = {k: tuple(v) for k, v in fallthroughs.items()}
+        # The schema version is always needed to tell if a document needs
+        # migrating, along with any old fields the migrations read, and the
+        # version to tell if it's been modified:
+        extra = []
+        if cls._migrations:
+            extra.append(cls._schema_version_field)
+            for _, migrate in cls._migrations.values():
+                extra.extend(migrate._migration_reads)
+        if cls._version_field is not None:
+            extra.append(cls._version_field)
+        cls._projection = (
+            _build_projection(fields.values(), extra) if strict else None
+        )
+        cls._validator = staticmethod(_compile_validator(fields))
+
+    @classmethod
+    async def validate_all(cls, cursor, max_errors=None):
+        """
+        Validate each document in `cursor` against this class's fields, using Motor.
+
+        Returns a list of `ValidationError`s, one for each invalid document,
+        stopping once there are `max_errors` of them. Raw BSON documents are
+        decoded lazily, so only the validated fields are decoded.
+        """
+        errors = []
+        validate = cls._validator
+        source = getattr(cursor, "collection", None)
+        async for doc in cursor:
+            error = _validation_error(cls, doc, validate, source)
+            if error is not None:
+                errors.append(error)
+                if len(errors) == max_errors:
+                    break
+        return errors
+
+    @classmethod
+    def validate_all_sync(cls, cursor, max_errors=None):
+        """
+        Validate each document in `cursor` against this class's fields, using PyMongo.
+
+        Returns a list of `ValidationError`s, one for each invalid document,
+        stopping once there are `max_errors` of them. Raw BSON documents are
+        decoded lazily, so only the validated fields are decoded.
+        """
+        errors = []
+        validate = cls._validator
+        source = getattr(cursor, "collection", None)
+        for doc in cursor:
+            error = _validation_error(cls, doc, validate, source)
+            if error is not None:
+                errors.append(error)
+                if len(errors) == max_errors:
+                    break
+        return errors
+
+    @classmethod
+    async def prefetch_related(cls, documents, name, chunk_size=100):
+        """
+        Load the superset items of the SequenceField `name` for many documents at once.
+
+        One aggregation is run against the field's `superset_collection` for
+        every `chunk_size` documents, instead of one query per document. Each
+        document's superset query is a `$unionWith` stage in it, so this saves
+        round trips rather than work on the server, and `chunk_size` keeps the
+        pipeline well below MongoDB's limit of 1000 stages. The results are
+        stored on each document, and used instead of querying the server when
+        the field is iterated, sliced or counted.
+        """
+        field = cls._fields[name]
+        documents = list(documents)
+        if field.superset_query is None:
+            return
+        for start in range(0, len(documents), chunk_size):
+            chunk = documents[start : start + chunk_size]
+            collection, pipeline = field._prefetch_pipeline(chunk)
+            results = [[] for _ in chunk]
+            async for item in collection.aggregate(pipeline):
+                results[item.pop(_PARENT_TAG)].append(item)
+            field._store_prefetched(chunk, results)
+
+    @classmethod
+    def prefetch_related_sync(cls, documents, name, chunk_size=100):
+        """
+        Load the superset items of the SequenceField `name` for many documents at once, using PyMongo.
+
+        See `prefetch_related`.
+        """
+        field = cls._fields[name]
+        documents = list(documents)
+        if field.superset_query is None:
+            return
+        for start in range(0, len(documents), chunk_size):
+            chunk = documents[start : start + chunk_size]
+            collection, pipeline = field._prefetch_pipeline(chunk)
+            results = [[] for _ in chunk]
+            for item in collection.aggregate(pipeline):
+                results[item.pop(_PARENT_TAG)].append(item)
+            field._store_prefetched(chunk, results)
+
+    async def load_sequences(self, *names, concurrency=None):
+        """
+        Load the SequenceFields `names` concurrently, returning a dict of item lists.
+
+        The superset query of each field is run at the same time (at most
+        `concurrency` at once, if it's provided), so the total latency is
+        that of the slowest query, rather than the sum of them all. The
+        superset items are stored on the document, so iterating, slicing or
+        counting the fields afterwards doesn't query the server again.
+        """
+        semaphore = None if concurrency is None else asyncio.Semaphore(concurrency)
+
+        async def load(name):
+            field = self._fields[name]
+            if field.superset_query is not None and field._prefetched(self) is None:
+                exclude = ()
+                if field.identity_key is not None:
+                    exclude = field._identities(self._doc.get(field.field_name, ()))
+                if semaphore is None:
+                    items = await _to_list(field._superset(self, exclude=exclude))
+                else:
+                    async with semaphore:
+                        items = await _to_list(field._superset(self, exclude=exclude))
+                field._store_prefetched([self], [items])
+            return [item async for item in getattr(self, name)]
+
+        results = await asyncio.gather(*(load(name) for name in names))
+        return dict(zip(names, results))
+
+    def to_dict(self):
+        """
+        Return the document as a dict, using the class's field mappings.
+
+        Declared fields are stored under their attribute names, with their
+        transforms applied, in place of the underlying fields they read.
+        For non-strict classes, the other underlying fields are included
+        as they are. SequenceFields include only their embedded items, and
+        ReferenceFields their stored keys.
+        """
+        fields = self._fields
+        if self._strict:
+            result = {}
+        else:
+            result = dict(self._doc)
+            for field in fields.values():
+                for field_name in getattr(field, "field_names", None) or (
+                    field.field_name,
+                ):
+                    result.pop(field_name, None)
+        for name, field in fields.items():
+            value = field._serialize(self)
+            if value is not _SENTINEL:
+                result[name] = value
+        return result
+
+    def to_json(self):
+        """
+        Return the document as a JSON string, using the class's field mappings.
+
+        BSON types are converted to JSON-friendly values: ObjectIds, UUIDs and
+        decimals become strings, dates become ISO 8601 strings, and binary
+        data becomes base64. See `to_dict` for which fields are included.
+        """
+        return _json_encoder.encode(self.to_dict())
+
+    @classmethod
+    def stream_json(cls, cursor, db=None, chunk_size=100):
+        """
+        Encode the documents in `cursor` as a JSON array, in chunks.
+
+        Returns an iterator of strings, each containing up to `chunk_size`
+        encoded documents, which can be sent as a streaming response.
+        Like `from_cursor`, this is an async iterator if `cursor` is one, so
+        it can also be used with the iterator returned by a `SequenceField`.
+        `cursor` may yield raw documents, which are wrapped in this class, or
+        `Document` instances.
+        """
+        if hasattr(cursor, "__aiter__"):
+            return _async_json_chunks(cls, cursor, db, chunk_size)
+        return _json_chunks(cls, cursor, db, chunk_size)
+
+    @classmethod
+    def to_columns(cls, cursor, names=None, chunk_size=10_000, arrays=True):
+        """
+        Read the declared fields of the documents in `cursor` into columns.
+
+        Returns an iterator of chunks, each a dict mapping attribute names
+        (all of the class's `Field`s and `FallthroughField`s, or just `names`)
+        to a column of values for up to `chunk_size` documents, so memory use
+        is bounded however many documents there are. Like `from_cursor`, this
+        is an async iterator if `cursor` is one.
+
+        Values are read straight from the underlying BSON documents, without
+        creating `Document` instances, and transforms are applied a column at
+        a time. If `arrays` is True, each column is a NumPy array, and the
+        `int`, `float`, `str` and `bool` transforms are applied by NumPy.
+        Otherwise, each column is a list. Missing values are None.
+        """
+        fields = cls._fields
+        if names is None:
+            names = [name for name, field in fields.items() if hasattr(field, "_column")]
+        columns = [(name, fields[name]) for name in names]
+        if arrays:
+            try:
+                import numpy
+            except ImportError as ie:
+                raise ImportError(
+                    "NumPy is required for arrays=True. Install docbridge[numpy]."
+                ) from ie
+        else:
+            numpy = None
+
+        if hasattr(cursor, "__aiter__"):
+            return _async_column_chunks(cls, cursor, columns, chunk_size, numpy)
+        return _column_chunks(cls, cursor, columns, chunk_size, numpy)
+
+    @classmethod
+    def projection(cls):
+        """
+        Return a projection containing only the document fields this class reads.
+
+        This is only possible for strict classes, because any field can be
+        read from a non-strict document with attribute lookup. For non-strict
+        classes, None is returned, which means "the whole document" when it is
+        passed to `find` or `find_one`.
+        """
+        return None if cls._projection is None else dict(cls._projection)
+
+
+def _migration_update(before, after):
+    """
+    Return an update document which turns `before` into `after`, field by field.
+    """
+    sets = {
+        key: value
+        for key, value in after.items()
+        if key != "_id" and (key not in before or before[key] != value)
+    }
+    update = {"$set": sets}
+    unsets = {key: "" for key in before if key not in after}
+    if unsets:
+        update["$unset"] = unsets
+    return update
+
+
+def _build_projection(fields, extra=()):
+    paths = set(extra)
+    for field in fields:
+        paths.update(field._projected_fields())
+
+    # MongoDB rejects projections containing both a path and its descendants:
+    projection = {
+        path: 1
+        for path in sorted(paths)
+        if not any(path.startswith(other + ".") for other in paths)
+    }
+    return projection or None
+
+
+def _compile_validator(fields):
+    """
+    Return a function which checks every field in `fields` against a BSON document in a single pass.
+
+    The function raises a `ValidationError` describing every invalid field.
+    """
+    checks = tuple(
+        (name, field._validate)
+        for name, field in fields.items()
+        if hasattr(field, "_validate")
+    )
+
+    def validate(doc):
+        errors = None
+        for name, check in checks:
+            error = check(doc)
+            if error is not None:
+                if errors is None:
+                    errors = {}
+                errors[name] = error
+        if errors is not None:
+            raise ValidationError(errors, doc.get("_id"))
+
+    return validate
+
+
+def _validation_error(cls, doc, validate, source=None):
+    try:
+        validate(_raw_doc(cls, doc, source))
+    except ValidationError as ve:
+        return ve
+    return None
+
+
+_set_doc = Document._doc.__set__
+_set_db = Document._db.__set__
+_set_dirty = Document._dirty.__set__
+_set_wrapped = Document._wrapped.__set__
+_set_related = Document._related.__set__
+_set_parent = Document._parent.__set__
+_set_pending = Document._pending.__set__
+
+
+def _specialise(descriptor, getter):
+    """
+    Replace the `__get__` method of a single descriptor instance with `getter`.
+
+    Python looks up `__get__` on the descriptor's type, so the descriptor is
+    moved to a subclass of its original class, which keeps `isinstance`
+    checks working.
+    """
+    generic = getattr(type(descriptor), "_generic_class", type(descriptor))
+    descriptor.__class__ = type(
+        generic.__name__,
+        (generic,),
+        {
+            "__get__": getter,
+            "__module__": generic.__module__,
+            "__qualname__": generic.__qualname__,
+            "_generic_class": generic,
+        },
+    )
+
+
+def _wrap(value, db, parent=None, key=None):
+    """
+    Wrap `value` in a `Document` or `DocumentArray`, if it's a dict or list.
+
+    The wrapper records that it is stored under `key` in `parent`, so that
+    changes made through it can be tracked on the top-level document.
+    """
+    if isinstance(value, dict):
+        wrapped = Document(value, db)
+        if parent is not None:
+            _set_parent(wrapped, (parent, key))
+        return wrapped
+    elif isinstance(value, list):
+        return DocumentArray(value, db, None if parent is None else (parent, key))
+    else:
+        return value
+
+
+def _unwrap(value):
+    if isinstance(value, Document):
+        return value._doc
+    elif isinstance(value, DocumentArray):
+        return value._items
+    else:
+        return value
+
+
+class DocumentArray(MutableSequence):
+    """
+    A lazy, list-like view over an array in a BSON document.
+
+    Elements are only wrapped (in `Document` or `DocumentArray` instances)
+    when they are accessed, and any changes are written straight through to
+    the underlying list, and tracked on the top-level document: appends are
+    recorded as `$push`, replacing an item as a `$set` of that item, and
+    other changes as a `$set` of the whole array.
+    """
+
+    __slots__ = ("_items", "_db", "_wrapped", "_parent")
+
+    def __init__(self, items, db, parent=None):
+        self._items = items
+        self._db = db
+        self._wrapped = None
+        self._parent = parent
+
+    def _wrap_at(self, index):
+        value = self._items[index]
+        if not isinstance(value, (dict, list)):
+            return value
+
+        cache = self._wrapped
+        if cache is None:
+            cache = self._wrapped = {}
+        else:
+            cached = cache.get(index)
+            if cached is not None and cached[0] is value:
+                return cached[1]
+
+        wrapped = _wrap(value, self._db, self, index)
+        cache[index] = (value, wrapped)
+        return wrapped
+
+    def _invalidate(self):
+        self._wrapped = None
+
+    def _record(self, operation, *args):
+        """
+        Record a change to this array on the top-level document, if there is one.
+        """
+        if self._parent is None:
+            return
+        root, path = _change_path(self)
+        if root is not None:
+            getattr(root._changes(), operation)(root._doc, path, *args)
+
+    def _index(self, index):
+        """Return `index` as a non-negative position, raising IndexError if it's out of range."""
+        length = len(self._items)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError(f"{self.__class__.__name__} index out of range")
+        return index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._wrap_at(i) for i in range(*index.indices(len(self._items)))]
+        return self._wrap_at(self._index(index))
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self._items[index] = [_unwrap(item) for item in value]
+            self._invalidate()
+            self._record("set", self._items)
+        else:
+            index = self._index(index)
+            value = self._items[index] = _unwrap(value)
+            if self._wrapped is not None:
+                self._wrapped.pop(index, None)
+            self._record("set_item", index, value)
+
+    def __delitem__(self, index):
+        del self._items[index]
+        self._invalidate()
+        self._record("set", self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        for index in range(len(self._items)):
+            yield self._wrap_at(index)
+
+    def __contains__(self, value):
+        return _unwrap(value) in self._items
+
+    def __eq__(self, other):
+        return self._items == _unwrap(other)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self._items!r})"
+
+    def insert(self, index, value):
+        self._items.insert(index, _unwrap(value))
+        self._invalidate()
+        self._record("set", self._items)
+
+    def append(self, value):
+        value = _unwrap(value)
+        # Appending doesn't move existing items, so wrapped items stay valid.
+        self._items.append(value)
+        self._record("push", value)
+
+
+def _change_path(wrapper, key=None):
+    """
+    Find the top-level document containing `wrapper`, and the dotted path to `key` in it.
+
+    Returns `(root, path)`, or `(None, None)` if `wrapper` isn't part of a
+    top-level document any more (because it was replaced or removed), in
+    which case there are no changes to track.
+    """
+    parts = [] if key is None else [str(key)]
+    node = wrapper
+    while node._parent is not None:
+        parent, parent_key = node._parent
+        raw = node._doc if isinstance(node, Document) else node._items
+        if isinstance(parent, Document):
+            if parent._doc.get(parent_key) is not raw:
+                return None, None
+        else:
+            items = parent._items
+            if not (
+                parent_key is not None
+                and parent_key < len(items)
+                and items[parent_key] is raw
+            ):
+                # The list may have been reordered since this item was wrapped,
+                # or the item's position was never known:
+                parent_key = next(
+                    (i for i, item in enumerate(items) if item is raw), None
+                )
+                if parent_key is None:
+                    return None, None
+        parts.append(str(parent_key))
+        node = parent
+
+    if not isinstance(node, Document):
+        return None, None
+    return node, ".".join(reversed(parts))
+
+
+class _Changes:
+    """
+    The changes made to a document, in a form that can be sent as a minimal update.
+
+    Changes are recorded by dotted path, and are normalised so that no two
+    paths in the update conflict: changes inside a path that is already being
+    `$set` are covered by that `$set`, and a `$push` that would conflict with
+    another change is replaced by a `$set` of the whole array.
+    """
+
+    __slots__ = ("sets", "unsets", "pushes")
+
+    def __init__(self):
+        self.sets = {}
+        self.unsets = {}
+        self.pushes = {}
+
+    def __bool__(self):
+        return bool(self.sets or self.unsets or self.pushes)
+
+    def _covered(self, doc, path):
+        """
+        Return True if a path containing `path` is already being `$set`.
+
+        The value being set is refreshed from `doc`, in case it has been
+        replaced since it was recorded.
+        """
+        ancestor = path.rpartition(".")[0]
+        while ancestor:
+            if ancestor in self.sets:
+                self.sets[ancestor] = _lookup(doc, ancestor)
+                return True
+            ancestor = ancestor.rpartition(".")[0]
+        return False
+
+    def _pushed_ancestor(self, path):
+        """Return the path of an array containing `path` which has items pushed to it."""
+        path = path.rpartition(".")[0]
+        while path:
+            if path in self.pushes:
+                return path
+            path = path.rpartition(".")[0]
+        return None
+
+    def _clear(self, path):
+        """Remove any recorded changes to `path`, or paths inside it."""
+        prefix = path + "."
+        for changes in (self.sets, self.unsets, self.pushes):
+            for other in [p for p in changes if p == path or p.startswith(prefix)]:
+                del changes[other]
+
+    def set(self, doc, path, value):
+        if self._covered(doc, path):
+            return
+        pushed = self._pushed_ancestor(path)
+        if pushed is not None:
+            # An array can't be pushed to and modified in the same update:
+            self.set(doc, pushed, _lookup(doc, pushed))
+            return
+        self._clear(path)
+        self.sets[path] = value
+
+    def set_item(self, doc, path, index, value):
+        if path in self.pushes:
+            self.set(doc, path, _lookup(doc, path))
+        else:
+            self.set(doc, f"{path}.{index}", value)
+
+    def unset(self, doc, path):
+        if self._covered(doc, path):
+            return
+        pushed = self._pushed_ancestor(path)
+        if pushed is not None:
+            self.set(doc, pushed, _lookup(doc, pushed))
+            return
+        self._clear(path)
+        self.unsets[path] = ""
+
+    def push(self, doc, path, value):
+        if path in self.sets:
+            # The array is already being set, and now includes the new item:
+            self.sets[path] = _lookup(doc, path)
+            return
+        if self._covered(doc, path):
+            return
+        prefix = path + "."
+        if (
+            path in self.unsets
+            or self._pushed_ancestor(path) is not None
+            or any(p.startswith(prefix) for p in self.sets)
+            or any(p.startswith(prefix) for p in self.unsets)
+        ):
+            # A $push would conflict with other changes, so $set the whole array:
+            self.set(doc, path, _lookup(doc, path))
+            return
+        self.pushes.setdefault(path, []).append(value)
+
+    def merge(self, doc, other):
+        """
+        Add the changes in `other`, which were made to `doc` after these ones.
+        """
+        for path, value in other.sets.items():
+            self.set(doc, path, value)
+        for path in other.unsets:
+            self.unset(doc, path)
+        for path, items in other.pushes.items():
+            for item in items:
+                self.push(doc, path, item)
+
+    def update_document(self):
+        update = {}
+        if self.sets:
+            update["$set"] = self.sets
+        if self.unsets:
+            update["$unset"] = self.unsets
+        if self.pushes:
+            update["$push"] = {
+                path: {"$each": items} for path, items in self.pushes.items()
+            }
+        return update
+
+
+def _lookup(doc, path):
+    """Return the value at the dotted `path` in `doc`."""
+    value = doc
+    for part in path.split("."):
+        value = value[int(part)] if isinstance(value, list) else value[part]
+    return value
+
+
+# The size of each BSON element type with a fixed-length value:
+_BSON_FIXED_SIZES = {
+    0x01: 8,  # double
+    0x06: 0,  # undefined
+    0x07: 12,  # ObjectId
+    0x08: 1,  # bool
+    0x09: 8,  # UTC datetime
+    0x0A: 0,  # null
+    0x10: 4,  # int32
+    0x11: 8,  # timestamp
+    0x12: 8,  # int64
+    0x13: 16,  # decimal128
+    0x7F: 0,  # max key
+    0xFF: 0,  # min key
+}
+# Element types whose value is an int32 byte length followed by that many bytes:
+_BSON_STRING_TYPES = {0x02, 0x0D, 0x0E}
+# Element types whose value starts with an int32 length that includes itself:
+_BSON_EMBEDDED_TYPES = {0x03, 0x04, 0x0F}
+
+_pack_int32 = struct.Struct("<i").pack
+_unpack_int32 = struct.Struct("<i").unpack_from
+_DELETED = object()
+# Tags each item of a bulk superset query with the index of its document:
+_PARENT_TAG = "_docbridge_parent"
+
+
+def _lazy_document(raw, source=None):
+    """
+    Wrap `raw` in a `LazyBSONDocument`, decoding with the codec options of `source`.
+
+    `source` is the database or collection the document was read from, if
+    it's known, so that options like `tz_aware` and `uuid_representation`
+    are respected.
+    """
+    codec_options = getattr(source, "codec_options", None)
+    if codec_options is None:
+        return LazyBSONDocument(raw)
+    return LazyBSONDocument(raw, codec_options.with_options(document_class=dict))
+
+
+class LazyBSONDocument(MutableMapping):
+    """
+    A mutable mapping over raw BSON bytes that only decodes the fields that are used.
+
+    Elements are located by scanning the raw bytes (without decoding them),
+    only as far as the requested key. Each top-level value is decoded the
+    first time it is read, and the decoded value is memoised. Sub-documents and
+    arrays are decoded as a whole, as `dict` and `list` values.
+
+    `Document` wraps `bytes` and `RawBSONDocument` values in this class automatically.
+    """
+
+    __slots__ = ("_raw", "_codec_options", "_offsets", "_position", "_values")
+
+    def __init__(self, raw, codec_options=DEFAULT_CODEC_OPTIONS):
+        if isinstance(raw, RawBSONDocument):
+            raw = raw.raw
+        self._raw = raw
+        self._codec_options = codec_options
+        # Maps each key that has been scanned to its element's byte span:
+        self._offsets = {}
+        # The offset of the next element to be scanned (skipping the length prefix):
+        self._position = 4
+        # Decoded, assigned or deleted values, which take precedence over _raw:
+        self._values = {}
+
+    @property
+    def raw(self):
+        """The raw BSON bytes this document was created from (without any changes)."""
+        return self._raw
+
+    def _scan(self):
+        """
+        Locate the next element in the raw bytes, returning its key.
+
+        Returns None when there are no more elements.
+        """
+        raw = self._raw
+        start = self._position
+        element_type = raw[start]
+        if element_type == 0:
+            return None
+
+        key_end = raw.index(b"\x00", start + 1)
+        key = raw[start + 1 : key_end].decode("utf-8")
+        value_start = key_end + 1
+
+        if element_type in _BSON_FIXED_SIZES:
+            end = value_start + _BSON_FIXED_SIZES[element_type]
+        elif element_type in _BSON_STRING_TYPES:
+            end = value_start + 4 + _unpack_int32(raw, value_start)[0]
+        elif element_type in _BSON_EMBEDDED_TYPES:
+            end = value_start + _unpack_int32(raw, value_start)[0]
+        elif element_type == 0x05:  # binary: length, subtype, data
+            end = value_start + 5 + _unpack_int32(raw, value_start)[0]
+        elif element_type == 0x0B:  # regex: pattern and options cstrings
+            end = raw.index(b"\x00", raw.index(b"\x00", value_start) + 1) + 1
+        elif element_type == 0x0C:  # DBPointer: string, then ObjectId
+            end = value_start + 4 + _unpack_int32(raw, value_start)[0] + 12
+        else:
+            raise bson.errors.InvalidBSON(
+                f"Unknown BSON element type {element_type:#04x} for key {key!r}."
+            )
+
+        self._offsets[key] = (start, end)
+        self._position = end
+        return key
+
+    def _find(self, key):
+        span = self._offsets.get(key)
+        while span is None:
+            scanned = self._scan()
+            if scanned is None:
+                raise KeyError(key)
+            if scanned == key:
+                span = self._offsets[key]
+        return span
+
+    def _scan_all(self):
+        while self._scan() is not None:
+            pass
+
+    def _decode(self, span):
+        start, end = span
+        element = self._raw[start:end]
+        # Wrap the single element in a document of its own, and decode that:
+        decoded = bson.decode(
+            _pack_int32(len(element) + 5) + element + b"\x00", self._codec_options
+        )
+        return next(iter(decoded.values()))
+
+    def __getitem__(self, key):
+        value = self._values.get(key, _SENTINEL)
+        if value is _SENTINEL:
+            value = self._values[key] = self._decode(self._find(key))
+        elif value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        value = self._values.get(key, _SENTINEL)
+        if value is _SENTINEL:
+            try:
+                self._find(key)
+            except KeyError:
+                return False
+            return True
+        return value is not _DELETED
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._values[key] = _DELETED
+
+    def __iter__(self):
+        self._scan_all()
+        values = self._values
+        for key in self._offsets:
+            if values.get(key) is not _DELETED:
+                yield key
+        for key, value in list(values.items()):
+            if key not in self._offsets and value is not _DELETED:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({dict(self)!r})"
 
 
 def identity(val):
@@ -109,11 +1317,33 @@ class Field:
     Currently it can be configured to map to a different field name in the
     underlying BSON document, and can apply an optional transformation to
     convert the field value to a desired type.
+
+    If `memoize` is True, the transformed value is cached on the instance, so
+    that expensive transforms (like parsing dates) only run once per value.
+    The cache is invalidated when the underlying field changes.
+
+    If `inverse` is provided, it's used to convert assigned values back to
+    the form stored in the BSON document. Otherwise, `transform` is applied
+    to assigned values before they're stored.
+
+    If `column_transform` is provided, it's used instead of `transform` by
+    `Document.to_columns`, and is called with a NumPy array of raw values.
     """
 
-    def __init__(self, field_name=None, default=NO_DEFAULT, transform=None):
+    def __init__(
+        self,
+        field_name=None,
+        default=NO_DEFAULT,
+        transform=None,
+        memoize=False,
+        inverse=None,
+        column_transform=None,
+    ):
         self.field_name = field_name
         self.transform = identity if transform is None else transform
+        self.memoize = memoize
+        self.inverse = inverse
+        self.column_transform = column_transform
 
     def __set_name__(self, owner, name):
         self.name = name
@@ -123,50 +1353,224 @@ class Field:
     def __get__(self, ob, cls):
         if ob is not None:
             try:
-                return self.transform(ob._doc[self.field_name])
+                value = ob._doc[self.field_name]
             except KeyError as ke:
-                raise ValueError(
-                    f"Attribute {self.name!r} is mapped to missing document property {self.field_name!r}."
-                ) from ke
+                raise self._missing() from ke
+            if self.memoize:
+                return _memoized(self, ob, value, self.transform)
+            return self.transform(value)
 
         return self
 
-    def __set__(self, ob, value: Any) -> None:
-        transformed_value = self.transform(value)
-        ob._doc[self.field_name] = transformed_value
-        print(f"Setting configured field {self.field_name} to {transformed_value}")
-        ob._modified_fields[self.field_name] = transformed_value
+    def _compile(self):
+        field_name = self.field_name
+        transform = self.transform
 
+        if transform is identity:
 
-class FallthroughField:
-    """
-    FallthroughField allows a series of different field names to be tried when looking up the attribute.
-    The first field name that exists in the underlying document will be the value that is returned.
+            def __get__(self, ob, cls=None):
+                if ob is None:
+                    return self
+                try:
+                    return ob._doc[field_name]
+                except KeyError as ke:
+                    raise self._missing() from ke
 
-    This class's functionality will probably be rolled into `Field` instead of being its own class.
-    """
+        elif self.memoize:
 
-    def __init__(self, field_names: Sequence[str]) -> None:
-        self.field_names = field_names
+            def __get__(self, ob, cls=None):
+                if ob is None:
+                    return self
+                try:
+                    value = ob._doc[field_name]
+                except KeyError as ke:
+                    raise self._missing() from ke
+                cache = ob._wrapped
+                if cache is not None:
+                    cached = cache.get(self)
+                    if cached is not None and cached[0] is value:
+                        return cached[1]
+                return _memoized(self, ob, value, transform)
 
-    def __get__(self, ob, cls):
-        for field_name in self.field_names:
-            try:
-                return ob._doc[field_name]
-            except KeyError:
-                pass
         else:
-            raise ValueError(
-                f"Attribute {self.name!r} references the field names {', '.join([repr(fn) for fn in self.field_names])} which are not present."
-            )
 
-    def __set_name__(self, owner, name):
-        self.name = name
+            def __get__(self, ob, cls=None):
+                if ob is None:
+                    return self
+                try:
+                    value = ob._doc[field_name]
+                except KeyError as ke:
+                    raise self._missing() from ke
+                return transform(value)
 
+        return __get__
 
-class SequenceField:
-    """
-    Allows an underlying array to have its elements wrapped in `Document` instances.
+    def _missing(self):
+        return ValueError(
+            f"Attribute {self.name!r} is mapped to missing document property {self.field_name!r}."
+        )
+
+    def _projected_fields(self):
+        return [self.field_name]
+
+    def _serialize(self, ob):
+        doc = ob._doc
+        if self.field_name not in doc:
+            return _SENTINEL
+        return self.__get__(ob, type(ob))
+
+    def _validate(self, doc):
+        try:
+            value = doc[self.field_name]
+        except KeyError:
+            return str(self._missing())
+        if self.transform is not identity:
+            try:
+                self.transform(value)
+            except Exception as e:
+                return f"Attribute {self.name!r} can't transform {value!r}: {e}"
+        return None
+
+    def _column(self, docs, numpy):
+        field_name = self.field_name
+        values = [doc.get(field_name) for doc in docs]
+        return _transform_column(values, self.transform, self.column_transform, numpy)
+
+    def __set__(self, ob, value: Any) -> None:
+        value = _unwrap(value)
+        if self.inverse is None:
+            stored = value = self.transform(value)
+        else:
+            stored = self.inverse(value)
+        ob._doc[self.field_name] = stored
+        ob._invalidate(self.field_name)
+        if self.memoize:
+            # The assigned value is already in its transformed form:
+            _cache(ob)[self] = (stored, value)
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug("Setting configured field %s to %r", self.field_name, stored)
+        ob._mark_modified(self.field_name, stored)
+
+
+def _cache(ob):
+    """Return the wrapped value cache for `ob`, allocating it if necessary."""
+    cache = ob._wrapped
+    if cache is None:
+        cache = {}
+        _set_wrapped(ob, cache)
+    return cache
+
+
+def _memoized(field, ob, value, transform):
+    """
+    Return `transform(value)`, cached on `ob` for the raw `value` of `field`.
+
+    Memoized values are stored in the same per-instance cache as wrapped
+    values, keyed by the field itself so they can't collide with dynamic
+    attribute lookups of the same document property.
+    """
+    cache = _cache(ob)
+    cached = cache.get(field)
+    if cached is not None and cached[0] is value:
+        return cached[1]
+    result = transform(value)
+    cache[field] = (value, result)
+    return result
+
+
+class FallthroughField:
+    """
+    FallthroughField allows a series of different field names to be tried when looking up the attribute.
+    The first field name that exists in the underlying document will be the value that is returned.
+
+    The field name that was found is cached on the instance, so later reads
+    are a single lookup.
+
+    This class's functionality will probably be rolled into `Field` instead of being its own class.
+    """
+
+    def __init__(self, field_names: Sequence[str]) -> None:
+        self.field_names = field_names
+
+    def __get__(self, ob, cls):
+        if ob is None:
+            return self
+        cache = ob._wrapped
+        if cache is not None:
+            field_name = cache.get(self)
+            if field_name is not None:
+                try:
+                    return ob._doc[field_name]
+                except KeyError:
+                    pass
+        return self._resolve(ob)
+
+    def _resolve(self, ob):
+        """
+        Find the field name to use for `ob`, and cache it, returning its value.
+        """
+        doc = ob._doc
+        for field_name in self.field_names:
+            if field_name in doc:
+                break
+        else:
+            raise self._missing()
+
+        _cache(ob)[self] = field_name
+        return doc[field_name]
+
+    def _missing(self):
+        return ValueError(
+            f"Attribute {self.name!r} references the field names {', '.join([repr(fn) for fn in self.field_names])} which are not present."
+        )
+
+    def _projected_fields(self):
+        return list(self.field_names)
+
+    def _serialize(self, ob):
+        doc = ob._doc
+        for field_name in self.field_names:
+            if field_name in doc:
+                return doc[field_name]
+        return _SENTINEL
+
+    def _validate(self, doc):
+        for field_name in self.field_names:
+            if field_name in doc:
+                return None
+        return str(self._missing())
+
+    def _column(self, docs, numpy):
+        field_names = self.field_names
+        values = [
+            next((doc[name] for name in field_names if name in doc), None)
+            for doc in docs
+        ]
+        return _transform_column(values, identity, None, numpy)
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+
+class SequenceField:
+    """
+    Allows an underlying array to have its elements wrapped in `Document` instances.
+
+    If `superset_query` is provided, then once the embedded items have been
+    exhausted, the query is run against `superset_collection` to obtain the
+    rest of the items. The query is only run if iteration gets that far,
+    unless `prefetch` is True, in which case the first batch of results is
+    fetched in the background while the embedded items are being consumed.
+
+    If `sort_key` is provided, the superset items are sorted by that field,
+    and the sequence can be paginated with `DocumentSequence.after`.
+
+    If `identity_key` is provided, superset items with the same value for
+    that field as an embedded item are excluded by the superset query, so
+    items duplicated by the subset pattern are only returned once.
+
+    If `cache` is a `DocumentCache`, superset query results are cached in
+    it, keyed by the query, and reused until they expire or are invalidated.
     """
 
     def __init__(
@@ -175,56 +1579,1592 @@ class SequenceField:
         field_name=None,
         superset_collection=None,
         superset_query: Callable = None,
+        project=True,
+        prefetch=False,
+        batch_size=None,
+        sort_key=None,
+        identity_key=None,
+        cache=None,
     ):
         self._type = type
         self.field_name = field_name
         self.superset_collection = superset_collection
         self.superset_query = superset_query
+        self.project = project
+        self.prefetch = prefetch
+        self.batch_size = batch_size
+        self.sort_key = sort_key
+        self.identity_key = identity_key
+        self.cache = cache
 
     def __get__(self, ob, cls):
-        if self.superset_query is None:
+        try:
+            # Return an iterable that first yields all the embedded items, and
+            # then once that is exhausted, queries the database for more.
+            return DocumentSequence(self, ob, ob._doc[self.field_name])
+        except KeyError as ke:
+            raise self._missing() from ke
+
+    def _superset_query(self, ob, after=_SENTINEL, exclude=()):
+        """
+        Return the superset collection, and the query to run against it.
+
+        The query is either a `find` filter (a mapping), or an aggregation
+        pipeline (a list). It is restricted to items after `after` if it's
+        provided, and to items whose `identity_key` is not in `exclude`.
+        """
+        # Call the superset_query callable to obtain the generated query:
+        query = self.superset_query(ob)
+        collection = ob._db.get_collection(self.superset_collection)
+
+        sort_key = self.sort_key
+        if after is not _SENTINEL and sort_key is None:
+            raise ValueError(
+                f"Attribute {self.name!r} can only be paginated if it is configured with a `sort_key`."
+            )
+
+        # If the query is a mapping, it's a `find` query, otherwise it's an
+        # aggregation pipeline.
+        criteria = {}
+        if exclude:
+            criteria[self.identity_key] = {"$nin": list(exclude)}
+        if after is not _SENTINEL:
+            criteria.setdefault(sort_key, {})["$gt"] = after
+
+        if isinstance(query, Mapping):
+            if criteria:
+                query = {"$and": [query, criteria]}
+        elif isinstance(query, Iterable):
+            query = list(query)
+            if criteria:
+                query.append({"$match": criteria})
+        else:
+            raise Exception("Returned was not a mapping or iterable.")
+        return collection, query
+
+    def _superset(self, ob, skip=0, limit=None, after=_SENTINEL, exclude=()):
+        if self.superset_query is None or limit == 0:
             # Use an empty sequence if there are no extra items.
             # It's still iterable, like a cursor, but immediately exits.
-            superset = []
+            return []
+
+        prefetched = self._prefetched(ob)
+        if prefetched is not None:
+            items = self._filter_prefetched(prefetched, after, exclude)
+            return items[skip:] if limit is None else items[skip : skip + limit]
+
+        collection, query = self._superset_query(ob, after, exclude)
+
+        projection = self._item_projection()
+        sort_key = self.sort_key
+
+        if isinstance(query, Mapping):
+            options = {}
+            if sort_key is not None:
+                options["sort"] = [(sort_key, 1)]
+            if skip:
+                options["skip"] = skip
+            if limit is not None:
+                options["limit"] = limit
+            if self.batch_size is not None:
+                options["batch_size"] = self.batch_size
+            method, args = collection.find, (query, projection)
         else:
-            # Call the superset_query callable to obtain the generated query:
-            query = self.superset_query(ob)
+            if sort_key is not None:
+                query.append({"$sort": {sort_key: 1}})
+            if skip:
+                query.append({"$skip": skip})
+            if limit is not None:
+                query.append({"$limit": limit})
+            if projection is not None:
+                query.append({"$project": projection})
+            options = {}
+            if self.batch_size is not None:
+                options["batchSize"] = self.batch_size
+            method, args = collection.aggregate, (query,)
+
+        if self.cache is None:
+            return method(*args, **options)
+        return self.cache._superset(collection, method, args, options)
+
+    def _item_projection(self):
+        """
+        Return the projection for superset items, or None to fetch whole items.
+
+        Only the fields that the item type reads are fetched, if it's strict,
+        along with the `sort_key` and `identity_key`, which are used to sort
+        and filter prefetched items.
+        """
+        projection = self._type._projection if self.project else None
+        if projection is None:
+            return None
+        projection = dict(projection)
+        for key in (self.sort_key, self.identity_key):
+            if key is not None:
+                projection[key] = 1
+        return projection
+
+    def _superset_count(self, ob, exclude=()):
+        """
+        Start counting the superset items on the server.
+
+        Returns the result of `count_documents` for a `find` query, or a
+        cursor over a single `$count` result document for a pipeline.
+        """
+        prefetched = self._prefetched(ob)
+        if prefetched is not None:
+            return len(self._filter_prefetched(prefetched, exclude=exclude))
 
-            # If the query is a mapping, it's a `find` query, otherwise it's an
-            # aggregation pipeline.
+        collection, query = self._superset_query(ob, exclude=exclude)
+        if isinstance(query, Mapping):
+            return collection.count_documents(query)
+        return collection.aggregate([*query, {"$count": "count"}])
+
+    def _prefetch_pipeline(self, documents):
+        """
+        Build a single pipeline returning the superset items for all of `documents`.
+
+        Each document's superset query becomes a sub-pipeline, combined with
+        `$unionWith`, and each item is tagged with the index of the document
+        it belongs to.
+        """
+        projection = self._item_projection()
+        collection = pipeline = None
+        for index, ob in enumerate(documents):
+            embedded = ob._doc.get(self.field_name, ())
+            collection, query = self._superset_query(
+                ob, exclude=self._identities(embedded)
+            )
             if isinstance(query, Mapping):
-                superset = ob._db.get_collection(self.superset_collection).find(query)
-            elif isinstance(query, Iterable):
-                superset = ob._db.get_collection(self.superset_collection).aggregate(
-                    query
+                query = [{"$match": query}]
+            if self.sort_key is not None:
+                query.append({"$sort": {self.sort_key: 1}})
+            if projection is not None:
+                query.append({"$project": projection})
+            query.append({"$addFields": {_PARENT_TAG: index}})
+
+            if pipeline is None:
+                pipeline = query
+            else:
+                pipeline.append(
+                    {"$unionWith": {"coll": self.superset_collection, "pipeline": query}}
                 )
+        return collection, pipeline
+
+    def _store_prefetched(self, documents, results):
+        sort_key = self.sort_key
+        for ob, items in zip(documents, results):
+            # $unionWith doesn't guarantee the order of its output:
+            if sort_key is not None:
+                items.sort(key=lambda item: item[sort_key])
+            if ob._related is None:
+                _set_related(ob, {})
+            ob._related[self.name] = items
+
+    def _prefetched(self, ob):
+        related = ob._related
+        return None if related is None else related.get(self.name)
+
+    def _filter_prefetched(self, items, after=_SENTINEL, exclude=()):
+        if exclude:
+            identity_key = self.identity_key
+            items = [item for item in items if item.get(identity_key) not in exclude]
+        if after is not _SENTINEL:
+            sort_key = self.sort_key
+            items = [item for item in items if item[sort_key] > after]
+        return items
+
+    def _compile(self):
+        field_name = self.field_name
+
+        def __get__(self, ob, cls=None):
+            if ob is None:
+                return self
+            try:
+                embedded = ob._doc[field_name]
+            except KeyError as ke:
+                raise self._missing() from ke
+            return DocumentSequence(self, ob, embedded)
+
+        return __get__
+
+    def _missing(self):
+        return ValueError(
+            f"Attribute {self.name!r} is mapped to missing document property {self.field_name!r}."
+        )
+
+    def _projected_fields(self):
+        projection = self._type._projection if self.project else None
+        if projection is None:
+            return [self.field_name]
+        return [f"{self.field_name}.{path}" for path in projection]
+
+    def _serialize(self, ob):
+        """Serialize the embedded items. Superset items aren't loaded."""
+        embedded = ob._doc.get(self.field_name, _SENTINEL)
+        if embedded is _SENTINEL:
+            return _SENTINEL
+        return [self._type(item, ob._db).to_dict() for item in embedded]
+
+    def _validate(self, doc):
+        try:
+            embedded = doc[self.field_name]
+        except KeyError:
+            return str(self._missing())
+        if not isinstance(embedded, list):
+            return f"Attribute {self.name!r} is mapped to {self.field_name!r}, which is not an array."
+        return None
+
+    def _identities(self, embedded):
+        """
+        Return the set of `identity_key` values of the embedded items.
+        """
+        identity_key = self.identity_key
+        if identity_key is None:
+            return set()
+        return {
+            item[identity_key]
+            for item in embedded
+            if isinstance(item, Mapping) and identity_key in item
+        }
+
+    async def superset_iterator(self, ob, embedded, related=None, **options):
+        """
+        Yield each of the `embedded` items, followed by the `related` items.
+
+        If `related` is None, then the superset query is used to obtain the
+        related items, as late as possible. Any `options` are used to
+        configure the superset query.
+
+        If the field has an `identity_key`, the superset query excludes
+        the embedded items (or those in `options["exclude"]` if it's
+        provided), and any related item that slips through anyway is skipped.
+        """
+        identity_key = self.identity_key
+        if identity_key is not None:
+            exclude = options.setdefault("exclude", self._identities(embedded))
+        first_related = None
+        if related is None and self.prefetch and self.superset_query is not None:
+            related = self._superset(ob, **options)
+            if not isinstance(related, (list, tuple)):
+                first_related = asyncio.ensure_future(_first(related))
+
+        try:
+            for document in self._wrap_embedded(ob, embedded):
+                yield document
+
+            if related is None:
+                related = self._superset(ob, **options)
+
+            if first_related is not None:
+                item = await first_related
+                if item is _SENTINEL:
+                    return
+                if identity_key is None or item.get(identity_key) not in exclude:
+                    yield self._type(item, ob._db)
+
+            if isinstance(related, (list, tuple)):
+                for item in related:
+                    if identity_key is None or item.get(identity_key) not in exclude:
+                        yield self._type(item, ob._db)
             else:
-                raise Exception("Returned was not a mapping or iterable.")
+                async for item in related:
+                    if identity_key is None or item.get(identity_key) not in exclude:
+                        yield self._type(item, ob._db)
+        finally:
+            if first_related is not None and not first_related.done():
+                first_related.cancel()
+
+    def superset_iterator_sync(self, ob, embedded, **options):
+        """
+        Yield each of the `embedded` items, followed by the superset items, using PyMongo.
+
+        This is the synchronous version of `superset_iterator`. If the field
+        is configured with `prefetch`, the superset query is started straight
+        away, and its results are read by a background thread, keeping up to
+        a batch of items ready while the caller processes earlier ones.
+        """
+        identity_key = self.identity_key
+        if identity_key is not None:
+            exclude = options.setdefault("exclude", self._identities(embedded))
+        related = None
+        if self.prefetch and self.superset_query is not None:
+            related = self._superset(ob, **options)
+            if not isinstance(related, (list, tuple)):
+                related = _BackgroundIterator(related, self.batch_size or 100)
 
         try:
-            # Return an iterable that first yields all the embedded items, and
-            # then once that is exhausted, queries the database for more.
-            return self.superset_iterator(
-                ob,
-                ob._doc[self.field_name],
-                superset,
-            )
-        except KeyError as ke:
-            raise ValueError(
-                f"Attribute {self.name!r} is mapped to missing document property {self.field_name!r}."
-            ) from ke
+            yield from self._wrap_embedded(ob, embedded)
 
-    async def superset_iterator(self, ob, embedded, related):
-        for item in embedded:
-            yield self._type(item, ob._db)
-        if isinstance(related, list):
+            if related is None:
+                related = self._superset(ob, **options)
             for item in related:
-                yield self._type(item, ob._db)
+                if identity_key is None or item.get(identity_key) not in exclude:
+                    yield self._type(item, ob._db)
+        finally:
+            if hasattr(related, "close"):
+                related.close()
+
+    def _wrap_embedded(self, ob, embedded):
+        if not embedded:
+            return
+        # Link embedded items to the array they came from, so that changes to
+        # them are tracked on `ob`:
+        array = ob._wrapped_value(self.field_name)
+        for item in embedded:
+            document = self._type(item, ob._db)
+            _set_parent(document, (array, None))
+            yield document
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        if self.field_name is None:
+            self.field_name = name
+
+
+class _BackgroundIterator:
+    """
+    Iterates over `cursor` in a background thread, keeping up to `size` items ready.
+
+    Closing the iterator stops the thread, which then closes the cursor.
+    """
+
+    def __init__(self, cursor, size):
+        self._cursor = cursor
+        self._items = queue.Queue(maxsize=size)
+        self._stop = threading.Event()
+        threading.Thread(target=self._fetch, daemon=True).start()
+
+    def _put(self, value):
+        while not self._stop.is_set():
+            try:
+                self._items.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fetch(self):
+        cursor = self._cursor
+        try:
+            for item in cursor:
+                if not self._put((item, None)):
+                    return
+        except Exception as e:
+            self._put((_SENTINEL, e))
+        else:
+            self._put((_SENTINEL, None))
+        finally:
+            if hasattr(cursor, "close"):
+                cursor.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._stop.is_set():
+            raise StopIteration
+        item, error = self._items.get()
+        if error is not None:
+            self.close()
+            raise error
+        if item is _SENTINEL:
+            self.close()
+            raise StopIteration
+        return item
+
+    def close(self):
+        self._stop.set()
+
+
+class DocumentSequence:
+    """
+    The items of a `SequenceField`, for a particular document.
+
+    This is an async iterator, which yields the embedded items followed by the
+    items returned by the field's superset query. With PyMongo, it can be
+    iterated with a regular `for` loop instead. It can also be sliced,
+    or paginated with `after`, in which case the embedded items are
+    selected locally and the rest of the work is done by the server.
+    """
+
+    __slots__ = ("_field", "_ob", "_embedded", "_iterator")
+
+    def __init__(self, field, ob, embedded):
+        self._field = field
+        self._ob = ob
+        self._embedded = embedded
+        self._iterator = None
+
+    def __aiter__(self):
+        return self
+
+    def __iter__(self):
+        return self._field.superset_iterator_sync(self._ob, self._embedded)
+
+    async def __anext__(self):
+        if self._iterator is None:
+            self._iterator = self._field.superset_iterator(self._ob, self._embedded)
+        return await self._iterator.__anext__()
+
+    def __getitem__(self, index):
+        """
+        Select items by position.
+
+        Slicing returns an async iterator over the selected items. Indexing
+        with an int returns an awaitable which resolves to the item.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.start or 0, index.stop, index.step or 1
+            if start < 0 or (stop is not None and stop < 0) or step < 1:
+                raise ValueError(
+                    "DocumentSequence only supports slices with non-negative bounds and a positive step."
+                )
+            return self._slice(start, stop, step)
+        elif index < 0:
+            raise IndexError("DocumentSequence does not support negative indices.")
         else:
-            async for item in related:
-                yield self._type(item, ob._db)
+            return self._item(index)
+
+    async def _slice(self, start, stop, step):
+        embedded_count = len(self._embedded)
+        skip = max(start - embedded_count, 0)
+        limit = None if stop is None else max(stop - max(start, embedded_count), 0)
+
+        items = self._field.superset_iterator(
+            self._ob,
+            self._embedded[start:stop],
+            skip=skip,
+            limit=limit,
+            exclude=self._field._identities(self._embedded),
+        )
+        position = 0
+        async for item in items:
+            if position % step == 0:
+                yield item
+            position += 1
+
+    async def _item(self, index):
+        async for item in self._slice(index, index + 1, 1):
+            return item
+        raise IndexError("DocumentSequence index out of range.")
+
+    async def count(self):
+        """
+        Count the items in this sequence, without fetching them.
+
+        The embedded items are counted locally, and the superset items are
+        counted by the server, using `count_documents` or a `$count` stage.
+        Use `count_sync` with PyMongo.
+        """
+        count = len(self._embedded)
+        if self._field.superset_query is None:
+            return count
+
+        result = self._field._superset_count(
+            self._ob, self._field._identities(self._embedded)
+        )
+        if isinstance(result, int):
+            return count + result
+        if inspect.isawaitable(result):
+            return count + await result
+        async for doc in result:
+            count += doc["count"]
+        return count
+
+    def count_sync(self):
+        """
+        Count the items in this sequence, without fetching them, using PyMongo.
+        """
+        count = len(self._embedded)
+        if self._field.superset_query is None:
+            return count
+
+        result = self._field._superset_count(
+            self._ob, self._field._identities(self._embedded)
+        )
+        if isinstance(result, int):
+            return count + result
+        for doc in result:
+            count += doc["count"]
+        return count
+
+    def after(self, value, limit=None):
+        """
+        Return an async iterator over the items whose `sort_key` is greater than `value`.
+
+        This requires the field to be configured with a `sort_key`, and
+        assumes that the embedded items are the first items in that order.
+        At most `limit` items are returned, if it is provided.
+        """
+        sort_key = self._field.sort_key
+        if sort_key is None:
+            raise ValueError(
+                f"Attribute {self._field.name!r} can only be paginated if it is configured with a `sort_key`."
+            )
+        embedded = [item for item in self._embedded if item[sort_key] > value]
+        if limit is not None:
+            embedded = embedded[:limit]
+            limit -= len(embedded)
+        return self._field.superset_iterator(
+            self._ob,
+            embedded,
+            after=value,
+            limit=limit,
+            exclude=self._field._identities(self._embedded),
+        )
+
+
+async def _to_list(cursor):
+    """Collect the items from a cursor, or a list of prefetched items."""
+    if isinstance(cursor, (list, tuple)):
+        return list(cursor)
+    return [item async for item in cursor]
+
+
+async def _first(cursor):
+    """Return the first item from an async iterator, or _SENTINEL if it's empty."""
+    try:
+        return await cursor.__anext__()
+    except StopAsyncIteration:
+        return _SENTINEL
+
+
+class ReferenceField:
+    """
+    Resolves an id (or a list of ids) stored in the document, to `Document` instances from another collection.
+
+    Reading the attribute returns an awaitable, which resolves to an instance
+    of `type` (or None if the referenced document doesn't exist), or a list
+    of them if the stored value is a list.
+
+    Lookups made in the same event-loop tick, such as from coroutines run
+    concurrently with `asyncio.gather`, are coalesced into a single `$in` query
+    per collection. Inside a `reference_scope`, results are also cached
+    until the scope exits.
+    """
+
+    def __init__(self, type, collection, field_name=None, key="_id"):
+        self._type = type
+        self.collection = collection
+        self.field_name = field_name
+        self.key = key
 
     def __set_name__(self, owner, name):
         self.name = name
         if self.field_name is None:
             self.field_name = name
+
+    def __get__(self, ob, cls):
+        if ob is None:
+            return self
+        try:
+            value = ob._doc[self.field_name]
+        except KeyError as ke:
+            raise self._missing() from ke
+        return self._resolve(ob, value)
+
+    def __set__(self, ob, value: Any) -> None:
+        """
+        Store a reference to a document (or a list of documents) by its key.
+
+        Each value may be a `Document`, a BSON document, or the key itself.
+        """
+        if isinstance(value, (list, DocumentArray)):
+            stored = [self._key_of(item) for item in value]
+        else:
+            stored = self._key_of(value)
+        ob._doc[self.field_name] = stored
+        ob._invalidate(self.field_name)
+        ob._mark_modified(self.field_name, stored)
+
+    def _key_of(self, value):
+        value = _unwrap(value)
+        return value[self.key] if isinstance(value, Mapping) else value
+
+    def _compile(self):
+        field_name = self.field_name
+        resolve = self._resolve
+
+        def __get__(self, ob, cls=None):
+            if ob is None:
+                return self
+            try:
+                value = ob._doc[field_name]
+            except KeyError as ke:
+                raise self._missing() from ke
+            return resolve(ob, value)
+
+        return __get__
+
+    def _missing(self):
+        return ValueError(
+            f"Attribute {self.name!r} is mapped to missing document property {self.field_name!r}."
+        )
+
+    def _projected_fields(self):
+        return [self.field_name]
+
+    def _serialize(self, ob):
+        """Serialize the stored keys, without resolving them."""
+        return ob._doc.get(self.field_name, _SENTINEL)
+
+    def _validate(self, doc):
+        if self.field_name not in doc:
+            return str(self._missing())
+        return None
+
+    async def _resolve(self, ob, value):
+        loader = _reference_loader(ob._db, self.collection, self.key)
+        if isinstance(value, list):
+            docs = await asyncio.gather(*[loader.load(item) for item in value])
+            return [None if doc is None else self._type(doc, ob._db) for doc in docs]
+        doc = await loader.load(value)
+        return None if doc is None else self._type(doc, ob._db)
+
+
+class ReferenceLoader:
+    """
+    Coalesces lookups by `key` against a single collection.
+
+    Every key passed to `load` during one event-loop tick is fetched with a
+    single `$in` query, at the end of the tick. If `cache` is True, the
+    results are kept, so each key is only ever fetched once by this loader.
+    """
+
+    def __init__(self, collection, key="_id", cache=True):
+        self._collection = collection
+        self._key = key
+        self._cache = cache
+        self._futures = {}
+        self._pending = {}
+        # The event loop only keeps weak references to tasks:
+        self._tasks = set()
+
+    def load(self, value):
+        """
+        Return a future that resolves to the document whose key is `value`, or None.
+        """
+        future = self._futures.get(value)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._futures[value] = loop.create_future()
+            if not self._pending:
+                loop.call_soon(self._dispatch)
+            self._pending[value] = future
+        return future
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        if not self._cache:
+            self._futures = {}
+        task = asyncio.ensure_future(self._fetch(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(self, pending):
+        try:
+            found = {}
+            query = {self._key: {"$in": list(pending)}}
+            async for doc in self._collection.find(query):
+                found[doc[self._key]] = doc
+        except Exception as e:
+            for value, future in pending.items():
+                # Don't cache failures, so that the next lookup tries again:
+                self._futures.pop(value, None)
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for value, future in pending.items():
+            if not future.done():
+                future.set_result(found.get(value))
+
+
+_reference_loaders = contextvars.ContextVar("docbridge_reference_loaders", default=None)
+_tick_loaders = weakref.WeakKeyDictionary()
+
+
+@contextlib.contextmanager
+def reference_scope():
+    """
+    Cache the documents resolved by `ReferenceField`s until the block exits.
+
+    This is designed to wrap the handling of a single request, so that each
+    referenced document is fetched at most once per request. Tasks started
+    inside the block share the cache.
+    """
+    token = _reference_loaders.set({})
+    try:
+        yield
+    finally:
+        _reference_loaders.reset(token)
+
+
+def _reference_loader(db, collection, key):
+    loaders = _reference_loaders.get()
+    cache = loaders is not None
+    if loaders is None:
+        # Outside a reference_scope, lookups are only coalesced within a tick:
+        loaders = _tick_loaders.setdefault(asyncio.get_running_loop(), {})
+
+    # Keyed by the database object, not its name, so that handles to
+    # different clients or with different codec options aren't shared. The
+    # loader keeps a reference to the database, so its id isn't reused.
+    loader_key = (id(db), collection, key)
+    loader = loaders.get(loader_key)
+    if loader is None:
+        loader = loaders[loader_key] = ReferenceLoader(
+            db.get_collection(collection), key, cache=cache
+        )
+        if not cache:
+            # Tick loaders are only shared until the end of the tick, so that
+            # they (and the database they hold) don't build up:
+            asyncio.get_running_loop().call_soon(
+                _drop_loader, loaders, loader_key, loader
+            )
+    return loader
+
+
+def _drop_loader(loaders, loader_key, loader):
+    if loaders.get(loader_key) is loader:
+        del loaders[loader_key]
+
+
+class SaveResult(NamedTuple):
+    """
+    The outcome of saving a single `Document` in a `UnitOfWork`.
+
+    `matched` is True if the update matched a document in the collection,
+    False if it didn't, and None if the update wasn't applied, either because
+    it failed (in which case `error` is set), or because an earlier update
+    failed in an ordered unit of work.
+    """
+
+    document: Document
+    matched: Optional[bool]
+    error: Optional[Exception] = None
+
+
+_unit_of_work = contextvars.ContextVar("docbridge_unit_of_work", default=None)
+
+
+class UnitOfWork:
+    """
+    Tracks modified `Document`s, and saves them with `bulk_write` when the block exits.
+
+    Use `async with` for Motor, or `with` for PyMongo. Each `document_class`
+    instance that is first modified inside the block is tracked
+    automatically, and other documents can be tracked with `add`. When the
+    block exits without an exception, each tracked document with changes is
+    saved to `collection`, in `bulk_write` batches of up to `batch_size`
+    updates, and a `SaveResult` for each of them is added to `results`.
+
+    Documents are matched by `_id`. Documents which were saved have their
+    modified fields cleared; the others keep theirs.
+    """
+
+    def __init__(
+        self, document_class, collection, ordered=True, batch_size=1000, session=None
+    ):
+        self.document_class = document_class
+        self.collection = collection
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.session = session
+        self.results = []
+        self._documents = {}
+        self._tokens = []
+
+    def add(self, document):
+        """
+        Track `document`, so that it will be saved when this unit of work is flushed.
+        """
+        self._documents[id(document)] = document
+
+    def __enter__(self):
+        self._tokens.append(_unit_of_work.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _unit_of_work.reset(self._tokens.pop())
+        if exc_type is None:
+            self.flush_sync()
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        _unit_of_work.reset(self._tokens.pop())
+        if exc_type is None:
+            await self.flush()
+
+    async def flush(self):
+        """
+        Save all of the tracked documents that have changes, using Motor.
+
+        Returns the results of this unit of work, which are also available as `results`.
+        """
+        batches = self._batches()
+        for collection, batch in batches:
+            operations = [operation for _, operation in batch]
+            try:
+                result = await collection.bulk_write(
+                    operations, ordered=self.ordered, session=self.session
+                )
+                matched, errors = result.matched_count, {}
+            except BulkWriteError as bwe:
+                matched, errors = bwe.details["nMatched"], _write_errors(bwe)
+
+            existing = None
+            if matched < len(batch) - len(errors):
+                query, projection = _stored_versions_query(batch)
+                cursor = collection.find(query, projection, session=self.session)
+                existing = {doc["_id"]: doc async for doc in cursor}
+
+            if not self._record(batch, errors, existing):
+                self._record_skipped(batches)
+                break
+        return self.results
+
+    def flush_sync(self):
+        """
+        Save all of the tracked documents that have changes, using PyMongo.
+
+        Returns the results of this unit of work, which are also available as `results`.
+        """
+        batches = self._batches()
+        for collection, batch in batches:
+            operations = [operation for _, operation in batch]
+            try:
+                result = collection.bulk_write(
+                    operations, ordered=self.ordered, session=self.session
+                )
+                matched, errors = result.matched_count, {}
+            except BulkWriteError as bwe:
+                matched, errors = bwe.details["nMatched"], _write_errors(bwe)
+
+            existing = None
+            if matched < len(batch) - len(errors):
+                query, projection = _stored_versions_query(batch)
+                cursor = collection.find(query, projection, session=self.session)
+                existing = {doc["_id"]: doc for doc in cursor}
+
+            if not self._record(batch, errors, existing):
+                self._record_skipped(batches)
+                break
+        return self.results
+
+    def _batches(self):
+        """
+        Yield `(collection, [(document, operation), ...])` for each batch of updates.
+        """
+        documents, self._documents = self._documents, {}
+        by_db = {}
+        for document in documents.values():
+            if document._dirty:
+                by_db.setdefault(id(document._db), []).append(document)
+
+        for documents in by_db.values():
+            collection = documents[0]._db.get_collection(self.collection)
+            batch = []
+            for document in documents:
+                try:
+                    operation = UpdateOne(
+                        document._match_criteria(), document._update_document()
+                    )
+                except Exception as e:
+                    self.results.append(SaveResult(document, None, e))
+                    continue
+                batch.append((document, operation))
+                if len(batch) == self.batch_size:
+                    yield collection, batch
+                    batch = []
+            if batch:
+                yield collection, batch
+
+    def _record(self, batch, errors, existing):
+        """
+        Record the results for a batch, returning False if later batches shouldn't be run.
+        """
+        proceed = True
+        for index, (document, _) in enumerate(batch):
+            if not proceed:
+                self.results.append(SaveResult(document, None))
+            elif index in errors:
+                self.results.append(SaveResult(document, None, errors[index]))
+                proceed = not self.ordered
+            elif existing is not None and not document._matched(
+                existing.get(document._doc["_id"])
+            ):
+                self.results.append(SaveResult(document, False))
+            else:
+                document._mark_saved()
+                _invalidate_caches(document._db, self.collection, document._doc["_id"])
+                self.results.append(SaveResult(document, True))
+        return proceed
+
+    def _record_skipped(self, batches):
+        for _, batch in batches:
+            for document, _ in batch:
+                self.results.append(SaveResult(document, None))
+
+
+def _stored_versions_query(batch):
+    """
+    Return the query and projection to read back the `_id`s and versions of a batch of documents.
+    """
+    ids = [document._doc["_id"] for document, _ in batch]
+    projection = {"_id": 1}
+    for document, _ in batch:
+        if document._version_field is not None:
+            projection[document._version_field] = 1
+    return {"_id": {"$in": ids}}, projection
+
+
+def _write_errors(bulk_write_error):
+    return {
+        error["index"]: WriteError(error.get("errmsg"), error.get("code"), error)
+        for error in bulk_write_error.details["writeErrors"]
+    }
+
+
+def migration(from_version, to_version, reads=()):
+    """
+    Declare a method of a `Document` subclass as a migration between schema versions.
+
+    The decorated function is called with the underlying document of each
+    instance whose schema version field is `from_version`, the first time
+    the instance's data is accessed. It should modify the document in place
+    (or return a replacement), and the schema version field is then set to
+    `to_version`. Migrations are chained until no more apply. Documents
+    without a schema version field have the version `None`.
+
+    `reads` lists any document fields the migration needs that aren't
+    declared on the class, such as the old name of a renamed field. They are
+    added to the projection of strict classes, which otherwise only fetches
+    declared fields.
+    """
+
+    def decorator(fn):
+        fn._migration = (from_version, to_version)
+        fn._migration_reads = tuple(reads)
+        return fn
+
+    return decorator
+
+
+def _check_migrations(migrations):
+    """
+    Raise a ValueError if following `migrations` from any version would never end.
+    """
+    for version in migrations:
+        seen = {version}
+        while version in migrations:
+            version = migrations[version][0]
+            if version in seen:
+                raise ValueError(
+                    f"Migrations to schema version {version!r} form a cycle."
+                )
+            seen.add(version)
+    return migrations
+
+
+_migration_writer = contextvars.ContextVar("docbridge_migration_writer", default=None)
+
+
+class MigrationWriter:
+    """
+    Writes documents that were migrated on read back to the database in batches.
+
+    Use `async with` for Motor, or `with` for PyMongo. Each top-level
+    `document_class` instance that is migrated inside the block is queued,
+    and the fields its migrations changed are written to `collection` with
+    `$set` and `$unset`, using `bulk_write`, in batches of up to
+    `batch_size`. With Motor, each full batch is written in the background
+    while the block carries on; with PyMongo it's written straight away.
+    Any remaining documents are written when the block exits.
+
+    Each update only matches if the stored document still has the schema
+    version it was read with, so a document that was migrated by someone
+    else in the meantime isn't overwritten. Only changed fields are
+    written, so fields that weren't projected, or that were updated by
+    someone else without changing the schema version, are left alone. The
+    number of documents updated is available as `written`.
+    """
+
+    def __init__(self, document_class, collection, batch_size=1000, session=None):
+        self.document_class = document_class
+        self.collection = collection
+        self.batch_size = batch_size
+        self.session = session
+        self.written = 0
+        self._queues = {}
+        self._tasks = set()
+        self._tokens = []
+        self._async = False
+
+    def add(self, document, version, update):
+        """
+        Queue `update` to be applied to `document`, if it still has the schema `version`.
+        """
+        db = document._db
+        queue = self._queues.setdefault(id(db), (db, []))[1]
+        queue.append(
+            UpdateOne(
+                {
+                    "_id": document._doc["_id"],
+                    document._schema_version_field: version,
+                },
+                update,
+            )
+        )
+        if len(queue) >= self.batch_size:
+            self._write(db, queue[:])
+            queue.clear()
+
+    def _write(self, db, operations):
+        collection = db.get_collection(self.collection)
+        if self._async:
+            task = asyncio.ensure_future(self._bulk_write(collection, operations))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            result = collection.bulk_write(
+                operations, ordered=False, session=self.session
+            )
+            self.written += result.modified_count
+
+    async def _bulk_write(self, collection, operations):
+        result = await collection.bulk_write(
+            operations, ordered=False, session=self.session
+        )
+        self.written += result.modified_count
+
+    def __enter__(self):
+        self._tokens.append(_migration_writer.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _migration_writer.reset(self._tokens.pop())
+        self.flush_sync()
+
+    async def __aenter__(self):
+        self._async = True
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        _migration_writer.reset(self._tokens.pop())
+        await self.flush()
+
+    async def flush(self):
+        """
+        Write all of the queued documents, using Motor, and wait for any background writes.
+        """
+        for db, queue in self._queues.values():
+            if queue:
+                self._write(db, queue[:])
+                queue.clear()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    def flush_sync(self):
+        """
+        Write all of the queued documents, using PyMongo.
+        """
+        for db, queue in self._queues.values():
+            if queue:
+                self._write(db, queue[:])
+                queue.clear()
+
+
+# Transforms which NumPy can apply to a whole column at once:
+_NUMPY_DTYPES = {int: "int64", float: "float64", str: "str", bool: "bool"}
+
+
+def _transform_column(values, transform, column_transform, numpy):
+    """
+    Apply `transform` to a list of raw values, and return it as a column.
+
+    If `numpy` is None, a list is returned. Otherwise, a NumPy array.
+    """
+    if numpy is not None:
+        if column_transform is not None:
+            return column_transform(_array(numpy, values))
+        dtype = _NUMPY_DTYPES.get(transform)
+        if dtype is not None and not any(value is None for value in values):
+            return _array(numpy, values, object).astype(dtype)
+    if transform is not identity:
+        values = [None if value is None else transform(value) for value in values]
+    return values if numpy is None else _array(numpy, values)
+
+
+def _array(numpy, values, dtype=None):
+    """
+    Convert `values` to a NumPy array, falling back to an object array.
+
+    An object array is needed if the values can't be converted to a single
+    type, or if they're sequences of different lengths.
+    """
+    if dtype is None:
+        try:
+            return numpy.array(values)
+        except ValueError:
+            pass
+    array = numpy.empty(len(values), dtype=object)
+    for index, value in enumerate(values):
+        array[index] = value
+    return array
+
+
+def _raw_doc(cls, doc, source=None):
+    """Prepare a raw document for reading without creating a `Document`."""
+    if isinstance(doc, (bytes, RawBSONDocument)):
+        # Only decode the fields that are read:
+        doc = _lazy_document(doc, source)
+    if cls._migrations:
+        doc = cls._apply_migrations(doc)[0]
+    return doc
+
+
+def _column_chunk(columns, docs, numpy):
+    return {name: field._column(docs, numpy) for name, field in columns}
+
+
+def _column_chunks(cls, cursor, columns, chunk_size, numpy):
+    source = getattr(cursor, "collection", None)
+    docs = (_raw_doc(cls, doc, source) for doc in cursor)
+    while True:
+        chunk = list(itertools.islice(docs, chunk_size))
+        if not chunk:
+            return
+        yield _column_chunk(columns, chunk, numpy)
+
+
+async def _async_column_chunks(cls, cursor, columns, chunk_size, numpy):
+    chunk = []
+    source = getattr(cursor, "collection", None)
+    async for doc in cursor:
+        chunk.append(_raw_doc(cls, doc, source))
+        if len(chunk) == chunk_size:
+            yield _column_chunk(columns, chunk, numpy)
+            chunk = []
+    if chunk:
+        yield _column_chunk(columns, chunk, numpy)
+
+
+def _json_default(value):
+    if isinstance(value, (ObjectId, uuid.UUID, Decimal128)):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(value, (Document, DocumentArray)):
+        return _unwrap(value)
+    return json_util.default(value, json_options=json_util.RELAXED_JSON_OPTIONS)
+
+
+_json_encoder = json.JSONEncoder(
+    default=_json_default, ensure_ascii=False, separators=(",", ":")
+)
+
+
+def _json_item(cls, item, db):
+    if not isinstance(item, Document):
+        item = cls(item, db)
+    return _json_encoder.encode(item.to_dict())
+
+
+def _json_chunks(cls, cursor, db, chunk_size):
+    items = iter(cursor)
+    separator = "["
+    while True:
+        chunk = [
+            _json_item(cls, item, db) for item in itertools.islice(items, chunk_size)
+        ]
+        if not chunk:
+            break
+        yield separator + ",".join(chunk)
+        separator = ","
+    yield "[]" if separator == "[" else "]"
+
+
+async def _async_json_chunks(cls, cursor, db, chunk_size):
+    separator = "["
+    chunk = []
+    async for item in cursor:
+        chunk.append(_json_item(cls, item, db))
+        if len(chunk) == chunk_size:
+            yield separator + ",".join(chunk)
+            separator = ","
+            chunk = []
+    if chunk:
+        yield separator + ",".join(chunk)
+        separator = ","
+    yield "[]" if separator == "[" else "]"
+
+
+class DocumentCache:
+    """
+    A bounded identity map of `Document`s by `_id`, and of superset query results.
+
+    Use `load` (with Motor) or `load_sync` (with PyMongo) to look up documents
+    by `_id`: while a document is cached, the same instance is returned every
+    time. Pass the cache to a `SequenceField` as `cache` to cache the results
+    of its superset queries.
+
+    At most `max_size` entries are kept, evicting the least recently used
+    first, and entries expire `ttl` seconds after they're cached, if `ttl`
+    is provided. Cached documents are invalidated when they're saved with
+    `Document.save` or a `UnitOfWork`, and cached superset results are
+    invalidated when any document in their collection is saved.
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Indexes of the keys in _entries, so that invalidation doesn't scan them:
+        self._supersets = {}
+        self._documents = {}
+        _document_caches.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return _SENTINEL
+        expires, value = entry
+        if expires is not None and expires < time.monotonic():
+            self._discard(key)
+            self.misses += 1
+            return _SENTINEL
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _put(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        if key[0] == "superset":
+            self._supersets.setdefault(key[1:3], set()).add(key)
+        else:
+            ids = self._documents.setdefault(key[1:3], {})
+            ids.setdefault(key[3], set()).add(key)
+        while len(self._entries) > self.max_size:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        if self._entries.pop(key, None) is None:
+            return
+        if key[0] == "superset":
+            keys = self._supersets.get(key[1:3])
+            if keys is not None:
+                keys.discard(key)
+        else:
+            ids = self._documents.get(key[1:3], {})
+            keys = ids.get(key[3])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del ids[key[3]]
+
+    def _document_key(self, cls, db, collection, _id):
+        # Entries are keyed by the database object, so that a document is
+        # never returned bound to a different client (such as a Motor
+        # document to a PyMongo caller), and indexed by its name, so that a
+        # save through any client invalidates them. The cached document
+        # keeps its database alive, so its id isn't reused while it's cached.
+        return ("document", db.name, collection, _id, cls, id(db))
+
+    def add(self, document, collection):
+        """
+        Cache `document`, which was loaded from `collection`, by its `_id`.
+        """
+        key = self._document_key(
+            type(document), document._db, collection, document._doc["_id"]
+        )
+        self._put(key, document)
+
+    async def load(self, cls, db, collection, id, session=None):
+        """
+        Return the `cls` instance for the document with `_id` `id` in `collection`, using Motor.
+
+        The document is fetched (using `session`, if provided), and cached,
+        if it isn't already. Returns None if there is no such document.
+        """
+        key = self._document_key(cls, db, collection, id)
+        document = self._get(key)
+        if document is _SENTINEL:
+            doc = await db.get_collection(collection).find_one(
+                {"_id": id}, cls.projection(), session=session
+            )
+            if doc is None:
+                return None
+            document = cls(doc, db)
+            self._put(key, document)
+        return document
+
+    def load_sync(self, cls, db, collection, id, session=None):
+        """
+        Return the `cls` instance for the document with `_id` `id` in `collection`, using PyMongo.
+
+        See `load`.
+        """
+        key = self._document_key(cls, db, collection, id)
+        document = self._get(key)
+        if document is _SENTINEL:
+            doc = db.get_collection(collection).find_one(
+                {"_id": id}, cls.projection(), session=session
+            )
+            if doc is None:
+                return None
+            document = cls(doc, db)
+            self._put(key, document)
+        return document
+
+    def _superset(self, collection, method, args, options):
+        """
+        Return the cached results of `method(*args, **options)`, or a cursor which caches them.
+
+        Results are cached as BSON, and decoded afresh for each hit, so
+        changes made to the items returned by one hit don't leak into the next.
+        """
+        query = bson.encode({"args": list(args), "options": options})
+        db = collection.database
+        key = ("superset", db.name, collection.name, query, id(db))
+        items = self._get(key)
+        codec_options = collection.codec_options
+        if items is not _SENTINEL:
+            return [bson.decode(item, codec_options) for item in items]
+        return _CachingCursor(method(*args, **options), self, key, codec_options)
+
+    def invalidate(self, db, collection, id=_SENTINEL):
+        """
+        Remove the cached document `id` in `collection` (or all of its documents), and its superset results.
+        """
+        collection_key = (db.name, collection)
+        for key in self._supersets.pop(collection_key, ()):
+            self._entries.pop(key, None)
+        if id is _SENTINEL:
+            ids = self._documents.pop(collection_key, {})
+            keys = [key for id_keys in ids.values() for key in id_keys]
+        else:
+            keys = self._documents.get(collection_key, {}).pop(id, ())
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove everything from the cache."""
+        self._entries.clear()
+        self._supersets.clear()
+        self._documents.clear()
+
+
+_document_caches = weakref.WeakSet()
+
+
+def _invalidate_caches(db, collection, id=_SENTINEL):
+    for cache in list(_document_caches):
+        cache.invalidate(db, collection, id)
+
+
+class _CachingCursor:
+    """
+    Wraps a PyMongo or Motor cursor, caching its results as BSON once it's exhausted.
+    """
+
+    def __init__(self, cursor, cache, key, codec_options):
+        self._cursor = cursor
+        self._cache = cache
+        self._key = key
+        self._codec_options = codec_options
+        self._items = []
+
+    def _add(self, item):
+        if isinstance(item, RawBSONDocument):
+            self._items.append(item.raw)
+        else:
+            self._items.append(bson.encode(item, codec_options=self._codec_options))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            item = next(self._cursor)
+        except StopIteration:
+            self._cache._put(self._key, self._items)
+            raise
+        self._add(item)
+        return item
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            item = await self._cursor.__anext__()
+        except StopAsyncIteration:
+            self._cache._put(self._key, self._items)
+            raise
+        self._add(item)
+        return item
+
+    def close(self):
+        if hasattr(self._cursor, "close"):
+            self._cursor.close()
+
+
+_write_behind_buffer = contextvars.ContextVar(
+    "docbridge_write_behind_buffer", default=None
+)
+
+
+class WriteBehindBuffer:
+    """
+    Coalesces repeated saves of the same documents into one write per flush.
+
+    Inside an `async with` block, `Document.save` calls for `collection`
+    (without `match_criteria` or a `session`) don't write to the database.
+    Instead, each document's changes are merged into a buffer, keyed by
+    `_id`. The buffer is flushed with a single `bulk_write`, sending one
+    update per document, `max_delay` seconds after the first change was
+    buffered, once `max_size` documents are buffered, and when the block
+    exits. Flushes are made one at a time, so a later update of a document
+    is never overtaken by an earlier one.
+
+    Errors from flushes made in the background are raised when the block
+    exits. The changes whose updates failed are put back in the buffer, to
+    be retried by the next flush, and any that still haven't been written
+    when the block exits are put back on their documents, so they can be
+    saved again.
+    """
+
+    def __init__(self, collection, max_delay=1.0, max_size=1000, session=None):
+        self.collection = collection
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.session = session
+        self._pending = {}
+        self._timer = None
+        self._lock = None
+        self._tasks = set()
+        self._tokens = []
+
+    def add(self, document):
+        """
+        Buffer the changes made to `document` since it was last saved.
+        """
+        changes = document._dirty
+        if not changes:
+            return
+        self._buffer(document, changes)
+        _set_dirty(document, None)
+
+        if len(self._pending) >= self.max_size:
+            self._flush_soon()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_delay, self._flush_soon
+            )
+
+    def _buffer(self, document, changes):
+        key = (id(document._db), document._match_criteria()["_id"])
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = (document, changes)
+        else:
+            pending[1].merge(document._doc, changes)
+
+    def _requeue(self, document, changes):
+        """
+        Put back the `changes` of a failed update, ahead of any buffered since.
+        """
+        key = (id(document._db), document._doc["_id"])
+        pending = self._pending.get(key)
+        if pending is not None:
+            changes.merge(document._doc, pending[1])
+        self._pending[key] = (document, changes)
+
+    def _flush_soon(self):
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """
+        Write all of the buffered changes, using Motor.
+
+        If any of the updates fail, their changes are put back in the buffer
+        and the error is raised.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # Wait for any flush that's already in progress:
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            by_db = {}
+            for document, changes in pending.values():
+                by_db.setdefault(id(document._db), []).append((document, changes))
+
+            error = None
+            for batch in by_db.values():
+                db = batch[0][0]._db
+                operations = [
+                    UpdateOne(document._match_criteria(), changes.update_document())
+                    for document, changes in batch
+                ]
+                try:
+                    await db.get_collection(self.collection).bulk_write(
+                        operations, ordered=False, session=self.session
+                    )
+                    failed = ()
+                except BulkWriteError as bwe:
+                    error, failed = bwe, _write_errors(bwe)
+                except Exception as e:
+                    error, failed = e, range(len(batch))
+                for index in failed:
+                    self._requeue(*batch[index])
+                for index, (document, _) in enumerate(batch):
+                    if index not in failed:
+                        _invalidate_caches(db, self.collection, document._doc["_id"])
+            if error is not None:
+                raise error
+
+    def _restore(self):
+        """
+        Put the changes that couldn't be written back on their documents.
+        """
+        pending, self._pending = self._pending, {}
+        for document, changes in pending.values():
+            if document._dirty is not None:
+                changes.merge(document._doc, document._dirty)
+            _set_dirty(document, changes)
+
+    async def __aenter__(self):
+        self._tokens.append(_write_behind_buffer.set(self))
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        _write_behind_buffer.reset(self._tokens.pop())
+        try:
+            # Background flushes finish first, and raise any errors they hit,
+            # but the final flush is still made, to retry their changes:
+            try:
+                if self._tasks:
+                    await asyncio.gather(*self._tasks)
+            finally:
+                await self.flush()
+        finally:
+            self._restore()
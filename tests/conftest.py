@@ -1,6 +1,8 @@
 import os
+import pytest
 import pytest_asyncio
 from motor.motor_asyncio import AsyncIOMotorClient as MotorClient
+from pymongo import MongoClient
 
 
 @pytest_asyncio.fixture(scope="session")
@@ -12,6 +14,14 @@ async def motor():
     return client
 
 
+@pytest.fixture(scope="session")
+def pymongo_client():
+    client = MongoClient(os.environ["MDB_URI"])
+    assert client.admin.command("ping")["ok"] > 0.5
+
+    return client
+
+
 @pytest_asyncio.fixture(scope="session")
 async def rollback_session(motor: MotorClient):
     """
@@ -12,11 +12,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import datetime
+
+import bson
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
 import pytest
 from pytest import fail
 import sys
+import uuid
 
-from docbridge import Document, Field, FallthroughField, SequenceField
+from docbridge import (
+    ConflictError,
+    Document,
+    DocumentArray,
+    DocumentCache,
+    Field,
+    FallthroughField,
+    LazyBSONDocument,
+    MigrationWriter,
+    ReferenceField,
+    SequenceField,
+    UnitOfWork,
+    ValidationError,
+    WriteBehindBuffer,
+    migration,
+    reference_scope,
+)
+from docbridge import _reference_loaders, _tick_loaders
 
 manhattan_data = {
     "_id": {"$oid": "63177d736c36240b38778162"},
@@ -78,6 +103,19 @@ def test_fallthrough():
         )
 
 
+def test_fallthrough_resolution_cache():
+    class Cocktail(Document):
+        name = FallthroughField(["name", "cocktail_name"])
+
+    manhattan = Cocktail({"cocktail_name": "Manhattan"}, None)
+    assert manhattan.name == "Manhattan"
+    assert manhattan._wrapped[Cocktail.name] == "cocktail_name"
+
+    # Each document is resolved in priority order:
+    sazerac = Cocktail({"name": "Sazerac", "cocktail_name": "Old"}, None)
+    assert sazerac.name == "Sazerac"
+
+
 @pytest.mark.asyncio(scope="session")
 async def test_mongodb_client(motor):
     assert (await motor.admin.command("ping"))["ok"] > 0.5
@@ -287,6 +325,105 @@ async def test_save(motor, rollback_session):
     assert profile._modified_fields == {}
 
 
+@pytest.mark.asyncio(scope="session")
+async def test_save_nested_changes(motor, rollback_session):
+    db = motor.get_database("why")
+    # Use a document that no other test modifies:
+    await db.get_collection("profiles").insert_one(
+        {
+            "_id": "nested-changes",
+            "user_id": "nested-changes",
+            "bio": "To be removed",
+            "followers": [{"user_id": "1", "user_name": "@one"}],
+        },
+        session=rollback_session,
+    )
+    profile = Document(
+        await db.get_collection("profiles").find_one(
+            {"user_id": "nested-changes"}, session=rollback_session
+        ),
+        db,
+    )
+    follower_count = len(profile.followers)
+
+    # Changes through sub-documents are recorded as dotted paths:
+    profile.followers[0].user_name = "@renamed"
+    del profile.bio
+    assert profile._update_document() == {
+        "$set": {"followers.0.user_name": "@renamed"},
+        "$unset": {"bio": ""},
+    }
+    await profile.save("profiles", session=rollback_session)
+
+    # Appending to an array is recorded as a $push:
+    profile.followers.append({"user_id": "new", "user_name": "@new"})
+    assert profile._update_document() == {
+        "$push": {"followers": {"$each": [{"user_id": "new", "user_name": "@new"}]}},
+    }
+    await profile.save("profiles", session=rollback_session)
+
+    doc = await db.get_collection("profiles").find_one(
+        {"user_id": "nested-changes"}, session=rollback_session
+    )
+    assert "bio" not in doc
+    assert len(doc["followers"]) == follower_count + 1
+    assert doc["followers"][0]["user_name"] == "@renamed"
+    assert doc["followers"][-1]["user_name"] == "@new"
+
+    # Extending an array in place stores and saves a plain list:
+    profile.comments = ["a"]
+    profile.comments += ["b"]
+    assert type(profile._doc["comments"]) is list
+    await profile.save("profiles", session=rollback_session)
+    doc = await db.get_collection("profiles").find_one(
+        {"user_id": "nested-changes"}, session=rollback_session
+    )
+    assert doc["comments"] == ["a", "b"]
+
+
+def test_nested_change_conflicts():
+    profile = Document(
+        {"_id": 1, "address": {"city": "Leeds"}, "tags": ["a"]}, None
+    )
+
+    # A change inside a path that's already being set is covered by it:
+    profile.address = {"city": "York", "street": "High St"}
+    profile.address.city = "Hull"
+    assert profile._update_document() == {
+        "$set": {"address": {"city": "Hull", "street": "High St"}}
+    }
+
+    # Modifying an array that has been pushed to collapses to a $set:
+    profile.tags.append("b")
+    profile.tags[0] = "z"
+    assert profile._update_document()["$set"]["tags"] == ["z", "b"]
+    assert "$push" not in profile._update_document()
+
+    # Wrappers that have been replaced don't record changes:
+    profile._dirty = None
+    address = profile.address
+    profile.address = {"city": "Bath"}
+    address.city = "Wells"
+    assert profile._update_document() == {"$set": {"address": {"city": "Bath"}}}
+
+    # Setting a field again replaces the recorded value:
+    profile.address = {"city": "Ely"}
+    assert profile._update_document() == {"$set": {"address": {"city": "Ely"}}}
+
+    # Pushing to an array that's being set updates the value being set:
+    profile._dirty = None
+    profile.tags = ["x"]
+    profile.tags.append("y")
+    assert profile._update_document() == {"$set": {"tags": ["x", "y"]}}
+
+
+def test_repeated_set():
+    profile = Document({"_id": 1, "x": 0}, None)
+    profile.x = 1
+    profile.x = 2
+    assert profile._update_document() == {"$set": {"x": 2}}
+
+
 def test_meta():
     class StrictProfile(Document, strict=True):
         user_id = Field(transform=str.lower)
@@ -297,3 +434,1194 @@ def test_meta():
         user_id = Field(transform=str.lower)
 
     assert Profile._strict is False
+
+
+def test_wrapped_values_are_cached():
+    profile = Document(
+        {
+            "address": {"city": "London"},
+            "followers": [{"user_id": "1"}, {"user_id": "2"}],
+        },
+        None,
+    )
+
+    address = profile.address
+    assert isinstance(address, Document)
+    assert profile.address is address
+    assert profile.followers is profile.followers
+
+    # Mutations made through the wrapper are visible on the next read:
+    address.city = "Edinburgh"
+    assert profile.address is address
+    assert profile.address.city == "Edinburgh"
+    assert profile._doc["address"]["city"] == "Edinburgh"
+
+    # Replacing the underlying value invalidates the cached wrapper:
+    profile.address = {"city": "Cardiff"}
+    assert profile.address is not address
+    assert profile.address.city == "Cardiff"
+
+
+def test_field_set_invalidates_wrapped_cache():
+    class Profile(Document):
+        location = Field(field_name="address")
+
+    profile = Profile({"address": {"city": "London"}}, None)
+    assert profile.address.city == "London"
+
+    profile.location = {"city": "Cardiff"}
+    assert profile.address.city == "Cardiff"
+
+
+def test_memoized_field():
+    calls = []
+
+    def parse(value):
+        calls.append(value)
+        return int(value)
+
+    class Profile(Document):
+        user_id = Field(transform=parse, memoize=True, inverse=str)
+
+    profile = Profile({"user_id": "4"}, None)
+    assert profile.user_id == 4
+    assert profile.user_id == 4
+    assert calls == ["4"]
+
+    # Assigned values are stored via the inverse, and not transformed again:
+    profile.user_id = 5
+    assert profile._doc["user_id"] == "5"
+    assert profile._modified_fields == {"user_id": "5"}
+    assert profile.user_id == 5
+    assert calls == ["4"]
+
+    # Changing the underlying document invalidates the memoized value:
+    profile._doc["user_id"] = "6"
+    assert profile.user_id == 6
+    assert calls == ["4", "6"]
+
+
+def test_document_array():
+    data = {
+        "followers": [{"user_id": str(i)} for i in range(1000)],
+        "comments": ["I love this cocktail", "Meh. It's not for me."],
+    }
+    profile = Document(data, None)
+
+    followers = profile.followers
+    assert isinstance(followers, DocumentArray)
+    assert len(followers) == 1000
+
+    # Only the accessed element is wrapped:
+    assert followers[0].user_id == "0"
+    assert followers[-1].user_id == "999"
+    assert len(followers._wrapped) == 2
+    assert followers[0] is followers[0]
+
+    assert [f.user_id for f in followers[10:13]] == ["10", "11", "12"]
+    assert {"user_id": "5"} in followers
+    assert followers[5] in followers
+    assert "Meh. It's not for me." in profile.comments
+    assert profile.comments == ["I love this cocktail", "Meh. It's not for me."]
+
+    # Writes go through to the underlying list:
+    followers.append(Document({"user_id": "1000"}, None))
+    assert data["followers"][-1] == {"user_id": "1000"}
+    followers[0] = {"user_id": "zero"}
+    assert followers[0].user_id == "zero"
+    del followers[1]
+    assert data["followers"][1] == {"user_id": "2"}
+    assert followers[1].user_id == "2"
+    followers[0].user_id = "nought"
+    assert data["followers"][0] == {"user_id": "nought"}
+
+    # Out of range indexes raise IndexError, like a list:
+    comments = profile.comments
+    for index in [2, -3]:
+        with pytest.raises(IndexError):
+            comments[index]
+        with pytest.raises(IndexError):
+            comments[index] = "Out of range"
+    assert comments[-2] == "I love this cocktail"
+    comments[-1] = "Actually, quite nice."
+    assert data["comments"] == ["I love this cocktail", "Actually, quite nice."]
+    with pytest.raises(IndexError):
+        Document({"empty": []}, None).empty[0] = 1
+
+
+def test_compiled_access_plan():
+    class Profile(Document):
+        id = Field(field_name="_id")
+        user_id = Field(transform=int)
+        name = FallthroughField(["name", "full_name"])
+
+    class ExtendedProfile(Profile):
+        email = Field()
+
+    assert isinstance(Profile.id, Field)
+    assert isinstance(Profile.name, FallthroughField)
+    assert set(Profile._fields) == {"id", "user_id", "name"}
+    assert set(ExtendedProfile._fields) == {"id", "user_id", "name", "email"}
+
+    profile = ExtendedProfile(
+        {"_id": "abc", "user_id": "4", "full_name": "Deborah White"}, None
+    )
+    assert profile.id == "abc"
+    assert profile.user_id == 4
+    assert profile.name == "Deborah White"
+    with pytest.raises(ValueError, match="missing document property 'email'"):
+        profile.email
+
+
+def test_compact_document():
+    class Profile(Document):
+        user_id = Field(transform=str.lower)
+
+    profile = Profile({"user_id": "4"}, None)
+    assert not hasattr(profile, "__dict__")
+
+    # The dirty-tracking dict is only allocated on first write:
+    assert profile._dirty is None
+    assert profile._modified_fields == {}
+    profile.user_id = "FOUR"
+    assert profile._modified_fields == {"user_id": "four"}
+    profile._modified_fields = {}
+    assert profile._dirty is None
+
+    # Plain class attributes can still be shadowed by instances:
+    class Defaults(Document):
+        x = None
+
+    defaults = Defaults({}, None)
+    defaults.x = 3
+    assert defaults.x == 3
+    assert Defaults.x is None
+
+
+def test_from_cursor():
+    class Profile(Document):
+        user_id = Field(transform=int)
+
+    profiles = Profile.from_cursor(iter([{"user_id": "1"}, {"user_id": "2"}]), None)
+    assert [profile.user_id for profile in profiles] == [1, 2]
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_from_async_cursor(motor):
+    class Profile(Document):
+        user_id = Field(transform=int)
+
+    db = motor.get_database("why")
+    cursor = db.get_collection("profiles").find({"user_id": {"$in": ["5", "6"]}})
+    user_ids = {profile.user_id async for profile in Profile.from_cursor(cursor, db)}
+    assert user_ids == {5, 6}
+
+
+def test_to_columns():
+    np = pytest.importorskip("numpy")
+
+    class Profile(Document):
+        user_id = Field(transform=int)
+        name = FallthroughField(["full_name", "user_name"])
+        joined = Field(column_transform=lambda a: a.astype("datetime64[s]"))
+
+    docs = [
+        {"user_id": str(i), "user_name": f"@{i}", "joined": "2024-01-01"}
+        for i in range(5)
+    ]
+    docs[2] = bson.encode({"user_id": "2", "full_name": "Two", "joined": "2024-01-02"})
+
+    chunks = list(Profile.to_columns(docs, chunk_size=2))
+    assert [len(chunk["user_id"]) for chunk in chunks] == [2, 2, 1]
+    assert chunks[0]["user_id"].dtype == np.int64
+    assert list(chunks[1]["user_id"]) == [2, 3]
+    assert list(chunks[1]["name"]) == ["Two", "@3"]
+    assert chunks[1]["joined"][0] == np.datetime64("2024-01-02")
+
+    # Lists can be produced instead, and missing values are None:
+    (chunk,) = Profile.to_columns([{"user_name": "@x"}], ["user_id", "name"], arrays=False)
+    assert chunk == {"user_id": [None], "name": ["@x"]}
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_to_columns_async(motor):
+    class Profile(Document):
+        user_id = Field(transform=int)
+
+    db = motor.get_database("why")
+    cursor = db.get_collection("profiles").find({}, Profile.projection())
+    total = 0
+    async for chunk in Profile.to_columns(cursor, chunk_size=3, arrays=False):
+        assert len(chunk["user_id"]) <= 3
+        total += len(chunk["user_id"])
+    assert total == await db.get_collection("profiles").count_documents({})
+
+
+def test_to_json():
+    import datetime
+    import json
+
+    class Follower(Document):
+        id = Field(field_name="_id", transform=str)
+
+    class Profile(Document):
+        id = Field(field_name="_id")
+        name = FallthroughField(["full_name", "user_name"])
+        followers = SequenceField(type=Follower)
+
+    oid = bson.ObjectId()
+    profile = Profile(
+        {
+            "_id": oid,
+            "user_name": "@tanya15",
+            "joined": datetime.datetime(2024, 1, 2, 3, 4, 5),
+            "followers": [{"_id": 1, "user_name": "@a"}],
+        },
+        None,
+    )
+    assert profile.to_dict() == {
+        "id": oid,
+        "name": "@tanya15",
+        "joined": datetime.datetime(2024, 1, 2, 3, 4, 5),
+        "followers": [{"id": "1", "user_name": "@a"}],
+    }
+    assert json.loads(profile.to_json()) == {
+        "id": str(oid),
+        "name": "@tanya15",
+        "joined": "2024-01-02T03:04:05",
+        "followers": [{"id": "1", "user_name": "@a"}],
+    }
+
+    class StrictProfile(Document, strict=True):
+        name = FallthroughField(["full_name", "user_name"])
+
+    assert StrictProfile(profile._doc, None).to_dict() == {"name": "@tanya15"}
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_stream_json(motor):
+    import json
+
+    class Profile(Document, strict=True):
+        user_id = Field()
+
+    db = motor.get_database("why")
+    cursor = db.get_collection("profiles").find({}, Profile.projection())
+    chunks = [chunk async for chunk in Profile.stream_json(cursor, chunk_size=2)]
+    assert len(chunks) > 2
+    streamed = json.loads("".join(chunks))
+    assert len(streamed) == await db.get_collection("profiles").count_documents({})
+    assert all(list(item) == ["user_id"] for item in streamed)
+
+    assert list(Profile.stream_json([])) == ["[]"]
+    assert "".join(Profile.stream_json([{"user_id": "1"}], chunk_size=1)) == (
+        '[{"user_id":"1"}]'
+    )
+
+
+def test_validation():
+    class Profile(Document, strict=True, validate=True):
+        user_id = Field(transform=int)
+        name = FallthroughField(["full_name", "user_name"])
+        followers = SequenceField(type=Document)
+
+    Profile({"user_id": "4", "user_name": "@a", "followers": []}, None)
+
+    with pytest.raises(ValidationError) as exc_info:
+        Profile(bson.encode({"_id": 1, "user_id": "four", "followers": {}}), None)
+    assert exc_info.value.document_id == 1
+    assert set(exc_info.value.errors) == {"user_id", "name", "followers"}
+
+    # Errors are collected for a whole cursor:
+    docs = [
+        {"_id": i, "user_id": str(i), "user_name": "@a", "followers": []}
+        for i in range(5)
+    ]
+    docs[1]["user_id"] = "one"
+    del docs[3]["user_name"]
+    errors = Profile.validate_all_sync(docs)
+    assert [(e.document_id, list(e.errors)) for e in errors] == [
+        (1, ["user_id"]),
+        (3, ["name"]),
+    ]
+    assert len(Profile.validate_all_sync(docs, max_errors=1)) == 1
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_validate_all(motor):
+    class Profile(Document, strict=True):
+        user_id = Field(transform=int)
+        email = Field()
+
+    db = motor.get_database("why")
+    cursor = db.get_collection("profiles").find({}, Profile.projection())
+    assert await Profile.validate_all(cursor) == []
+
+
+def test_lazy_bson_document():
+    class Profile(Document):
+        user_id = Field(transform=int)
+        name = FallthroughField(["name", "full_name"])
+
+    raw = bson.encode(
+        {
+            "user_id": "4",
+            "full_name": "Deborah White",
+            "address": {"city": "London"},
+            "comments": ["First!"],
+        }
+    )
+
+    profile = Profile(raw, None)
+    assert isinstance(profile._doc, LazyBSONDocument)
+    assert profile.user_id == 4
+    # Only the fields that have been read have been decoded:
+    assert set(profile._doc._values) == {"user_id"}
+
+    assert profile.name == "Deborah White"
+    assert profile.address.city == "London"
+    assert set(profile._doc._values) == {"user_id", "full_name", "address"}
+
+    profile.comments.append("Second!")
+    profile.email = "deanjacob@yahoo.com"
+    del profile._doc["full_name"]
+    assert dict(profile._doc) == {
+        "user_id": "4",
+        "address": {"city": "London"},
+        "comments": ["First!", "Second!"],
+        "email": "deanjacob@yahoo.com",
+    }
+
+    profile = Profile(RawBSONDocument(raw), None)
+    assert profile.user_id == 4
+
+    # Values are decoded with the database's codec options:
+    client = MongoClient(
+        "mongodb://localhost", connect=False, tz_aware=True, uuidRepresentation="standard"
+    )
+    db = client.get_database("why")
+    raw = bson.encode(
+        {
+            "joined": datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc),
+            "token": uuid.UUID(int=1),
+        },
+        codec_options=db.codec_options,
+    )
+    profile = Document(raw, db)
+    assert profile.joined.tzinfo is not None
+    assert profile.token == uuid.UUID(int=1)
+    client.close()
+
+
+def test_projection():
+    class Follower(Document, strict=True):
+        user_name = Field()
+
+    class Profile(Document, strict=True):
+        id = Field(field_name="_id")
+        name = FallthroughField(["full_name", "name"])
+        followers = SequenceField(type=Follower)
+
+    assert Profile.projection() == {
+        "_id": 1,
+        "followers.user_name": 1,
+        "full_name": 1,
+        "name": 1,
+    }
+
+    class LooseProfile(Document):
+        id = Field(field_name="_id")
+
+    assert LooseProfile.projection() is None
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_sequence_field_superset_projection(motor):
+    class Follower(Document, strict=True):
+        user_name = Field()
+
+    class Profile(Document):
+        followers = SequenceField(
+            type=Follower,
+            superset_collection="followers",
+            superset_query=lambda ob: [
+                {
+                    "$match": {"user_id": ob.user_id},
+                },
+                {"$unwind": "$followers"},
+                {"$replaceRoot": {"newRoot": "$followers"}},
+            ],
+        )
+
+    db = motor.get_database("why")
+    profile = Profile(
+        await db.get_collection("profiles").find_one({"user_id": "4"}), db
+    )
+    related = [follower async for follower in profile.followers][20:]
+    assert related
+    assert all(set(follower._doc) <= {"_id", "user_name"} for follower in related)
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_sequence_field_deferred_superset_query():
+    queried = []
+
+    class Profile(Document):
+        followers = SequenceField(
+            type=Document,
+            superset_collection="followers",
+            superset_query=lambda ob: queried.append(ob) or {"user_id": ob.user_id},
+        )
+
+    profile = Profile({"user_id": "4", "followers": [{"user_id": "1"}]}, None)
+    followers = profile.followers
+    assert (await anext(followers)).user_id == "1"
+    assert queried == []
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_sequence_field_prefetch(motor):
+    class Follower(Document):
+        _id = Field(transform=str)
+
+    class Profile(Document):
+        followers = SequenceField(
+            type=Follower,
+            superset_collection="followers",
+            superset_query=lambda ob: [
+                {
+                    "$match": {"user_id": ob.user_id},
+                },
+                {"$unwind": "$followers"},
+                {"$replaceRoot": {"newRoot": "$followers"}},
+            ],
+            prefetch=True,
+            batch_size=10,
+        )
+
+    db = motor.get_database("why")
+    profile = Profile(
+        await db.get_collection("profiles").find_one({"user_id": "4"}), db
+    )
+    followers = [follower._id async for follower in profile.followers]
+    assert len(followers) == 59
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_sequence_field_slicing_embedded():
+    class Profile(Document):
+        followers = SequenceField(type=Document, sort_key="user_id")
+
+    profile = Profile(
+        {"followers": [{"user_id": f"{i:02}"} for i in range(10)]},
+        None,
+    )
+    assert [f.user_id async for f in profile.followers[2:5]] == ["02", "03", "04"]
+    assert [f.user_id async for f in profile.followers[7:]] == ["07", "08", "09"]
+    assert [f.user_id async for f in profile.followers[1:6:2]] == ["01", "03", "05"]
+    assert (await profile.followers[3]).user_id == "03"
+    with pytest.raises(IndexError):
+        await profile.followers[10]
+
+    assert [f.user_id async for f in profile.followers.after("06")] == [
+        "07",
+        "08",
+        "09",
+    ]
+    assert [f.user_id async for f in profile.followers.after("02", limit=2)] == [
+        "03",
+        "04",
+    ]
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_sequence_field_superset_slicing(motor):
+    class Follower(Document):
+        _id = Field(transform=str)
+
+    def followers_query(ob):
+        return [
+            {"$match": {"user_id": ob.user_id}},
+            {"$unwind": "$followers"},
+            {"$replaceRoot": {"newRoot": "$followers"}},
+        ]
+
+    class Profile(Document):
+        followers = SequenceField(
+            type=Follower,
+            superset_collection="followers",
+            superset_query=followers_query,
+            sort_key="user_name",
+        )
+
+    db = motor.get_database("why")
+    profile = Profile(
+        await db.get_collection("profiles").find_one({"user_id": "4"}), db
+    )
+    everything = [follower.user_name async for follower in profile.followers]
+    assert len(everything) == 59
+
+    page = [follower.user_name async for follower in profile.followers[18:25]]
+    assert page == everything[18:25]
+    deep_page = [follower.user_name async for follower in profile.followers[40:45]]
+    assert deep_page == everything[40:45]
+
+    embedded, related = everything[:20], sorted(everything[20:])
+    after = [
+        follower.user_name
+        async for follower in profile.followers.after(related[10], limit=5)
+    ]
+    expected = [name for name in embedded if name > related[10]][:5]
+    expected += related[11 : 11 + 5 - len(expected)]
+    assert after == expected
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_sequence_field_count(motor):
+    class Profile(Document):
+        followers = SequenceField(
+            type=Document,
+            superset_collection="followers",
+            superset_query=lambda ob: [
+                {"$match": {"user_id": ob.user_id}},
+                {"$unwind": "$followers"},
+                {"$replaceRoot": {"newRoot": "$followers"}},
+            ],
+        )
+        buckets = SequenceField(
+            type=Document,
+            field_name="followers",
+            superset_collection="followers",
+            superset_query=lambda ob: {"user_id": ob.user_id},
+        )
+
+    db = motor.get_database("why")
+    profile = Profile(
+        await db.get_collection("profiles").find_one({"user_id": "4"}), db
+    )
+    assert await profile.followers.count() == 59
+    assert await profile.buckets.count() == 22
+
+    class EmbeddedProfile(Document):
+        followers = SequenceField(type=Document)
+
+    profile = EmbeddedProfile({"followers": [{}, {}]}, None)
+    assert await profile.followers.count() == 2
+    assert profile.followers.count_sync() == 2
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_sequence_field_identity_key(motor):
+    class Profile(Document):
+        friends = SequenceField(
+            type=Document,
+            superset_collection="profiles",
+            superset_query=lambda ob: {"user_id": {"$in": ["5", "6", "7", "8"]}},
+            identity_key="user_id",
+            sort_key="user_id",
+        )
+
+    db = motor.get_database("why")
+    profile = Profile({"friends": [{"user_id": "5"}, {"user_id": "6"}]}, db)
+
+    friends = [friend.user_id async for friend in profile.friends]
+    assert friends == ["5", "6", "7", "8"]
+    assert await profile.friends.count() == 4
+    assert [friend.user_id async for friend in profile.friends[1:3]] == ["6", "7"]
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_prefetch_related(motor):
+    class Follower(Document):
+        _id = Field(transform=str)
+
+    class Profile(Document):
+        followers = SequenceField(
+            type=Follower,
+            superset_collection="followers",
+            superset_query=lambda ob: [
+                {"$match": {"user_id": ob.user_id}},
+                {"$unwind": "$followers"},
+                {"$replaceRoot": {"newRoot": "$followers"}},
+            ],
+        )
+
+    db = motor.get_database("why")
+    cursor = db.get_collection("profiles").find({"user_id": {"$in": ["3", "4"]}})
+    profiles = [profile async for profile in Profile.from_cursor(cursor, db)]
+    expected = {
+        profile.user_id: [follower._id async for follower in profile.followers]
+        for profile in profiles
+    }
+
+    # Documents are prefetched in chunks of at most chunk_size:
+    await Profile.prefetch_related(profiles, "followers", chunk_size=1)
+    for profile in profiles:
+        assert profile._related["followers"] is not None
+        followers = [follower._id async for follower in profile.followers]
+        assert sorted(followers) == sorted(expected[profile.user_id])
+        assert await profile.followers.count() == len(expected[profile.user_id])
+
+    # The sort key is fetched even if a strict item type doesn't declare it:
+    class StrictFollower(Document, strict=True):
+        user_id = Field()
+
+    class SortedProfile(Document):
+        followers = SequenceField(
+            type=StrictFollower,
+            superset_collection="followers",
+            superset_query=Profile.followers.superset_query,
+            sort_key="user_name",
+        )
+
+    profile = SortedProfile(profiles[1]._doc, db)
+    await SortedProfile.prefetch_related([profile], "followers")
+    names = [item["user_name"] for item in profile._related["followers"]]
+    assert names == sorted(names)
+
+
+def test_sequence_field_sync(pymongo_client):
+    class Follower(Document):
+        _id = Field(transform=str)
+
+    def superset_query(ob):
+        return [
+            {"$match": {"user_id": ob.user_id}},
+            {"$unwind": "$followers"},
+            {"$replaceRoot": {"newRoot": "$followers"}},
+        ]
+
+    class Profile(Document):
+        followers = SequenceField(
+            type=Follower,
+            superset_collection="followers",
+            superset_query=superset_query,
+        )
+        prefetched_followers = SequenceField(
+            type=Follower,
+            field_name="followers",
+            superset_collection="followers",
+            superset_query=superset_query,
+            prefetch=True,
+            batch_size=5,
+        )
+
+    db = pymongo_client.get_database("why")
+    profile = Profile(db.get_collection("profiles").find_one({"user_id": "4"}), db)
+    followers = [follower.user_name for follower in profile.followers]
+    assert len(followers) == 59
+    assert followers[19:21] == ["@nbrown", "@hooperchristopher"]
+    assert [f.user_name for f in profile.prefetched_followers] == followers
+
+    # Stopping early stops the background thread:
+    iterator = iter(profile.prefetched_followers)
+    assert next(iterator).user_name == followers[0]
+    iterator.close()
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_load_sequences(motor):
+    class Follower(Document):
+        _id = Field(transform=str)
+
+    def superset_query(ob):
+        return [
+            {"$match": {"user_id": ob.user_id}},
+            {"$unwind": "$followers"},
+            {"$replaceRoot": {"newRoot": "$followers"}},
+        ]
+
+    class Profile(Document):
+        followers = SequenceField(
+            type=Follower,
+            superset_collection="followers",
+            superset_query=superset_query,
+        )
+        recent_followers = SequenceField(
+            type=Follower,
+            field_name="followers",
+            superset_collection="followers",
+            superset_query=superset_query,
+        )
+
+    db = motor.get_database("why")
+    profile = Profile(
+        await db.get_collection("profiles").find_one({"user_id": "4"}), db
+    )
+    expected = [follower._id async for follower in profile.followers]
+
+    loaded = await profile.load_sequences(
+        "followers", "recent_followers", concurrency=1
+    )
+    assert list(loaded) == ["followers", "recent_followers"]
+    assert [follower._id for follower in loaded["followers"]] == expected
+    assert [follower._id for follower in loaded["recent_followers"]] == expected
+    # The superset items are kept, so the fields can be used without querying:
+    assert profile._related.keys() == {"followers", "recent_followers"}
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_reference_field(motor):
+    class Friend(Document):
+        name = Field(field_name="full_name")
+
+    class Profile(Document):
+        best_friend = ReferenceField(Friend, collection="profiles", key="user_id")
+        friends = ReferenceField(Friend, collection="profiles", key="user_id")
+
+    db = motor.get_database("why")
+    profiles = [
+        Profile({"best_friend": "4", "friends": ["5", "missing"]}, db),
+        Profile({"best_friend": "5", "friends": ["4"]}, db),
+    ]
+
+    with reference_scope():
+        best_friends = await asyncio.gather(*[p.best_friend for p in profiles])
+        assert [friend.name for friend in best_friends] == [
+            "Deborah White",
+            (await db.profiles.find_one({"user_id": "5"}))["full_name"],
+        ]
+
+        friends = await profiles[0].friends
+        assert friends[0].name == best_friends[1].name
+        assert friends[1] is None
+
+        # Both ReferenceFields share a single loader, which has cached each key:
+        [loader] = _reference_loaders.get().values()
+        assert set(loader._futures) == {"4", "5", "missing"}
+
+        # Another handle on a database with the same name gets its own loader:
+        other_db = motor.get_database("why", codec_options=db.codec_options)
+        assert other_db is not db
+        await Profile({"best_friend": "4"}, other_db).best_friend
+        assert len(_reference_loaders.get()) == 2
+
+    profiles[1].best_friend = friends[0]
+    assert profiles[1]._doc["best_friend"] == "5"
+
+    # Outside a reference_scope, loaders are dropped at the end of each tick:
+    for _ in range(5):
+        handle = motor.get_database("why", codec_options=db.codec_options)
+        assert (await Profile({"best_friend": "4"}, handle).best_friend).name
+    assert _tick_loaders[asyncio.get_running_loop()] == {}
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_unit_of_work(motor, rollback_session):
+    class Profile(Document):
+        user_id = Field(transform=str.lower)
+
+    class Post(Document):
+        pass
+
+    db = motor.get_database("why")
+    # Use documents that no other test modifies:
+    user_ids = ["uow-1", "uow-2", "uow-3"]
+    await db.get_collection("profiles").insert_many(
+        [{"_id": user_id, "user_id": user_id} for user_id in user_ids],
+        session=rollback_session,
+    )
+    profiles = [
+        Profile(
+            await db.get_collection("profiles").find_one(
+                {"user_id": user_id}, session=rollback_session
+            ),
+            db,
+        )
+        for user_id in user_ids
+    ]
+    missing = Profile({"_id": "does-not-exist", "user_id": "7"}, db)
+    post = Post({"_id": "uow-1", "title": "Not a profile"}, db)
+
+    async with UnitOfWork(
+        Profile, "profiles", batch_size=2, session=rollback_session
+    ) as unit_of_work:
+        for profile in profiles:
+            profile.bio = f"New bio for {profile.user_id}"
+        missing.user_id = "X"
+        # Documents of other classes aren't tracked:
+        post.title = "Still not a profile"
+        # Unmodified documents are ignored:
+        unit_of_work.add(Profile({"_id": "unmodified"}, db))
+
+    results = {result.document.user_id: result for result in unit_of_work.results}
+    assert set(results) == {*user_ids, "x"}
+    assert all(results[user_id].matched for user_id in user_ids)
+    assert results["x"].matched is False
+    assert results["x"].error is None
+
+    assert all(profile._modified_fields == {} for profile in profiles)
+    assert missing._modified_fields == {"user_id": "x"}
+    assert post._modified_fields == {"title": "Still not a profile"}
+
+    doc = await db.get_collection("profiles").find_one(
+        {"user_id": "uow-2"}, session=rollback_session
+    )
+    assert doc["bio"] == "New bio for uow-2"
+    assert "title" not in doc
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_migration(motor, rollback_session):
+    class Profile(Document):
+        @migration(None, 1)
+        def split_name(doc):
+            doc["first_name"], _, doc["last_name"] = doc.pop("full_name").partition(
+                " "
+            )
+
+        @migration(1, 2)
+        def rename_bio(doc):
+            doc["biography"] = doc.pop("bio")
+
+    db = motor.get_database("why")
+    profiles = db.get_collection("profiles")
+    # Use documents that no other test modifies:
+    user_ids = ["migration-1", "migration-2", "migration-3"]
+    await profiles.insert_many(
+        [
+            {
+                "user_id": user_id,
+                "full_name": "Deborah White",
+                "bio": "Bio",
+                "email": "deborah@example.com",
+            }
+            for user_id in user_ids
+        ],
+        session=rollback_session,
+    )
+    async with MigrationWriter(
+        Profile, "profiles", batch_size=2, session=rollback_session
+    ) as writer:
+        cursor = profiles.find(
+            {"user_id": {"$in": user_ids}}, session=rollback_session
+        )
+        migrated = [profile async for profile in Profile.from_cursor(cursor, db)]
+        # Documents are only migrated when they're accessed:
+        assert "full_name" in migrated[0]._pending
+        assert migrated[0].first_name == "Deborah"
+        assert migrated[0].schema_version == 2
+        assert "bio" not in migrated[0]._doc
+        for profile in migrated[1:]:
+            assert profile.schema_version == 2
+    assert writer.written == 3
+
+    doc = await profiles.find_one({"user_id": "migration-1"}, session=rollback_session)
+    assert doc["schema_version"] == 2
+    assert doc["first_name"] == "Deborah"
+    assert "bio" not in doc
+
+    # Already migrated documents aren't written back again:
+    with MigrationWriter(Profile, "profiles") as writer:
+        assert Profile(doc, db).schema_version == 2
+    assert writer.written == 0
+
+    # Projected documents only have their changed fields written back:
+    class StrictProfile(Document, strict=True):
+        biography = Field()
+
+        @migration(2, 3)
+        def shout(doc):
+            doc["biography"] = doc["biography"].upper()
+
+    assert StrictProfile.projection() == {"biography": 1, "schema_version": 1}
+    async with MigrationWriter(
+        StrictProfile, "profiles", session=rollback_session
+    ) as writer:
+        doc = await profiles.find_one(
+            {"user_id": "migration-1"},
+            StrictProfile.projection(),
+            session=rollback_session,
+        )
+        assert StrictProfile(doc, db).biography == "BIO"
+    assert writer.written == 1
+
+    doc = await profiles.find_one(
+        {"user_id": "migration-1"},
+        StrictProfile.projection(),
+        session=rollback_session,
+    )
+    # The schema version is projected, so the document isn't migrated again:
+    assert doc["schema_version"] == 3
+    doc = await profiles.find_one({"user_id": "migration-1"}, session=rollback_session)
+    assert doc["biography"] == "BIO"
+    assert doc["email"] == "deborah@example.com"
+
+
+def test_migration_reads_projected():
+    class StrictProfile(Document, strict=True):
+        biography = Field()
+
+        @migration(None, 1, reads=["bio"])
+        def rename_bio(doc):
+            doc["biography"] = doc.pop("bio")
+
+    # The old field name is fetched, even though it isn't declared:
+    assert StrictProfile.projection() == {
+        "bio": 1,
+        "biography": 1,
+        "schema_version": 1,
+    }
+    stored = {"_id": 1, "bio": "Bio", "email": "deborah@example.com"}
+    projected = {k: v for k, v in stored.items() if k in StrictProfile.projection()}
+    profile = StrictProfile(projected, None)
+    assert profile.biography == "Bio"
+    assert profile._doc["schema_version"] == 1
+
+
+def test_migration_cycle():
+    with pytest.raises(ValueError):
+
+        class Profile(Document):
+            @migration(1, 2)
+            def forward(doc):
+                pass
+
+            @migration(2, 1)
+            def back(doc):
+                pass
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_document_cache(motor, rollback_session):
+    import time
+
+    class Follower(Document):
+        pass
+
+    cache = DocumentCache(max_size=3, ttl=60)
+
+    class Profile(Document):
+        followers = SequenceField(
+            type=Follower,
+            superset_collection="followers",
+            superset_query=lambda ob: [
+                {"$match": {"user_id": ob.followers_of}},
+                {"$unwind": "$followers"},
+                {"$replaceRoot": {"newRoot": "$followers"}},
+            ],
+            cache=cache,
+        )
+
+    db = motor.get_database("why")
+    # Use a profile that no other test modifies, sharing user 4's followers:
+    _id = "document-cache"
+    await db.get_collection("profiles").insert_one(
+        {"_id": _id, "user_id": _id, "followers_of": "4", "followers": []},
+        session=rollback_session,
+    )
+
+    # The same instance is returned while it's cached:
+    profile = await cache.load(Profile, db, "profiles", _id, session=rollback_session)
+    assert profile.user_id == _id
+    assert await cache.load(Profile, db, "profiles", _id) is profile
+    assert await cache.load(Profile, db, "profiles", "missing") is None
+
+    # Superset results are cached once they've been read:
+    followers = [f async for f in profile.followers]
+    user_names = [f.user_name for f in followers]
+    hits = cache.hits
+    assert [f.user_name async for f in profile.followers] == user_names
+    assert cache.hits == hits + 1
+
+    # ... and changes to the items from one read don't leak into the next:
+    followers[0].user_name = "@changed"
+    assert [f.user_name async for f in profile.followers] == user_names
+
+    # Saving invalidates the document:
+    profile.bio = "Updated"
+    await profile.save("profiles", session=rollback_session)
+    assert cache._documents[("why", "profiles")] == {}
+    reloaded = await cache.load(
+        Profile, db, "profiles", _id, session=rollback_session
+    )
+    assert reloaded is not profile
+    assert reloaded.bio == "Updated"
+
+    # The least recently used entries are evicted:
+    for user_id in ["5", "6", "7"]:
+        doc = await db.get_collection("profiles").find_one({"user_id": user_id})
+        cache.add(Profile(doc, db), "profiles")
+    assert len(cache) == 3
+    assert await cache.load(Profile, db, "profiles", _id) is not reloaded
+
+    # ... and entries expire:
+    cache.ttl = 0.01
+    cache.add(reloaded, "profiles")
+    time.sleep(0.02)
+    assert await cache.load(Profile, db, "profiles", _id) is not reloaded
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_document_cache_per_client(motor, pymongo_client):
+    cache = DocumentCache()
+    motor_db = motor.get_database("why")
+    pymongo_db = pymongo_client.get_database("why")
+    doc = await motor_db.get_collection("profiles").find_one({"user_id": "8"})
+
+    # Each client gets its own instance, bound to its own database:
+    profile = await cache.load(Document, motor_db, "profiles", doc["_id"])
+    synced = cache.load_sync(Document, pymongo_db, "profiles", doc["_id"])
+    assert synced is not profile
+    assert synced._db is pymongo_db
+    assert cache.load_sync(Document, pymongo_db, "profiles", doc["_id"]) is synced
+
+    # ... but a save through either client invalidates both:
+    cache.invalidate(pymongo_db, "profiles", doc["_id"])
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_write_behind_buffer(motor, rollback_session):
+    db = motor.get_database("why")
+    profiles = db.get_collection("profiles")
+    # Use documents that no other test modifies:
+    await profiles.insert_many(
+        [
+            {"_id": "write-behind-1", "followers": []},
+            {"_id": "write-behind-2", "bio": "Bio"},
+            {"_id": "write-behind-3"},
+        ],
+        session=rollback_session,
+    )
+
+    async def find(_id):
+        return await profiles.find_one({"_id": _id}, session=rollback_session)
+
+    profile = Document(await find("write-behind-1"), db)
+    other = Document(await find("write-behind-2"), db)
+
+    async with WriteBehindBuffer(
+        "profiles", max_delay=60, session=rollback_session
+    ) as buffer:
+        for count in range(10):
+            profile.visits = count
+            assert await profile.save("profiles") is None
+        profile.followers.append({"user_id": "new"})
+        await profile.save("profiles")
+        other.bio = "Buffered"
+        await other.save("profiles")
+
+        # Many saves are merged into one update per document:
+        assert len(buffer._pending) == 2
+        _, changes = buffer._pending[(id(db), profile._id)]
+        assert changes.update_document() == {
+            "$set": {"visits": 9},
+            "$push": {"followers": {"$each": [{"user_id": "new"}]}},
+        }
+        assert (await find("write-behind-1")).get("visits") is None
+
+    doc = await find("write-behind-1")
+    assert doc["visits"] == 9
+    assert doc["followers"] == [{"user_id": "new"}]
+    assert (await find("write-behind-2"))["bio"] == "Buffered"
+
+    # Buffered changes are flushed after max_delay:
+    async with WriteBehindBuffer("profiles", max_delay=0.01, session=rollback_session):
+        profile.visits = 10
+        await profile.save("profiles")
+        await asyncio.sleep(0.05)
+        assert (await find("write-behind-1"))["visits"] == 10
+
+    # Flushes are made in order, so the latest change is written last:
+    async with WriteBehindBuffer("profiles", max_size=1, session=rollback_session):
+        for count in range(11, 15):
+            profile.visits = count
+            await profile.save("profiles")
+    assert (await find("write-behind-1"))["visits"] == 14
+
+    # Changes which fail to be written are put back on the document:
+    failing = Document(await find("write-behind-3"), db)
+    with pytest.raises(BulkWriteError):
+        async with WriteBehindBuffer("profiles", session=rollback_session):
+            # The server rejects changes to _id:
+            failing._mark_modified("_id", "changed")
+            await failing.save("profiles")
+            other.bio = "Written"
+            await other.save("profiles")
+    assert failing._update_document() == {"$set": {"_id": "changed"}}
+    assert (await find("write-behind-2"))["bio"] == "Written"
+    assert other._modified_fields == {}
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_versioned_save(motor):
+    class Profile(Document, version_field="revision"):
+        pass
+
+    class StrictProfile(Document, strict=True, version_field="revision"):
+        bio = Field()
+
+    # The version is always projected, so that it can be matched on:
+    assert StrictProfile.projection() == {"bio": 1, "revision": 1}
+
+    db = motor.get_database("why")
+    # Use a scratch collection, which is dropped afterwards:
+    profiles = db.get_collection("versioned_profiles")
+    await profiles.insert_one({"_id": "versioned", "bio": "Bio"})
+    try:
+        await _check_versioned_save(Profile, StrictProfile, db, profiles)
+    finally:
+        await profiles.drop()
+
+
+async def _check_versioned_save(Profile, StrictProfile, db, profiles):
+    profile = Profile(await profiles.find_one(), db)
+    stale = Profile(await profiles.find_one(), db)
+    assert profile._match_criteria() == {"_id": "versioned", "revision": None}
+
+    profile.bio = "First"
+    result = await profile.save("versioned_profiles")
+    assert result.matched_count == 1
+    assert profile.revision == 1
+    assert (await profiles.find_one())["revision"] == 1
+
+    # The stale copy was loaded before the first save, so its update is lost:
+    stale.bio = "Lost"
+    with pytest.raises(ConflictError) as excinfo:
+        await stale.save("versioned_profiles")
+    assert excinfo.value.document is stale
+    assert (await profiles.find_one())["bio"] == "First"
+
+    # With on_conflict, the document is reloaded and the change re-applied:
+    def reapply(document):
+        assert document.bio == "First"
+        document.bio = document.bio + " and second"
+
+    await stale.save("versioned_profiles", on_conflict=reapply)
+    assert stale.revision == 2
+    doc = await profiles.find_one()
+    assert doc["bio"] == "First and second"
+    assert doc["revision"] == 2
+
+    # Strict documents are reloaded with their projection, including the version:
+    strict = StrictProfile(
+        await profiles.find_one({}, StrictProfile.projection()), db
+    )
+    await profiles.update_one({}, {"$inc": {"revision": 1}})
+
+    def reapply_strict(document):
+        assert document._doc["revision"] == 3
+        document.bio = "Strict"
+
+    strict.bio = "Lost"
+    await strict.save("versioned_profiles", on_conflict=reapply_strict)
+    assert strict._doc["revision"] == 4
+    assert (await profiles.find_one())["bio"] == "Strict"
+
+    # Versioned documents are written immediately, not buffered:
+    async with WriteBehindBuffer("versioned_profiles") as buffer:
+        strict.bio = "Unbuffered"
+        assert (await strict.save("versioned_profiles")).matched_count == 1
+        assert buffer._pending == {}
+
+    # Lost updates are reported by a unit of work, too:
+    profile.bio = "Lost again"
+    strict.bio = "Saved"
+    async with UnitOfWork(Document, "versioned_profiles") as unit_of_work:
+        unit_of_work.add(profile)
+        unit_of_work.add(strict)
+    matched = {result.document.bio: result.matched for result in unit_of_work.results}
+    assert matched == {"Lost again": False, "Saved": True}
+    assert profile.revision == 1
+    assert strict._doc["revision"] == 6